@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Jan Hudec <bulb@ucw.cz>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for podiffutils.
+
+Generates synthetic base, local and remote catalogs of given size and
+measures the merge on them. With --interpreter, merge throughput is also
+measured in other interpreters, so CPython and PyPy can be compared.
+"""
+
+from argparse import ArgumentParser
+import io
+import json
+import multiprocessing
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from translate.storage.pypo import pofile
+
+import podiffutils
+
+_header = r'''msgid ""
+msgstr ""
+"Project-Id-Version: Bench 1.0\n"
+"POT-Creation-Date: 2013-12-11 11:30+0100\n"
+"PO-Revision-Date: 2013-12-11 11:40+0100\n"
+"Language: cs\n"
+"MIME-Version: 1.0\n"
+"Content-Type: text/plain; charset=utf-8\n"
+"Content-Transfer-Encoding: 8bit\n"
+'''
+
+def _entry(i, translation, locations=None, obsolete=False):
+    if obsolete:
+        return ('#~ msgid "Message number %d with some %%s text"\n'
+                '#~ msgstr "%s"\n') % (i, translation)
+    if locations is None:
+        locations = ['src/module%d.c:%d' % (i % 17, i),
+                'src/other.c:%d' % (i * 3)]
+    return ('#. Developer comment for message number %d\n'
+            '#: %s\n'
+            '#, c-format\n'
+            'msgid "Message number %d with some %%s text"\n'
+            'msgstr "%s"\n') % (i, ' '.join(locations), i, translation)
+
+def _render(entries, header=_header):
+    return '\n'.join([header] + [_entry(*e) for e in entries])
+
+def _edits(n, rnd):
+    base = [(i, 'Zprava cislo %d s %%s textem' % i) for i in range(n)]
+
+    def modify(side):
+        out = []
+        for i, t in base:
+            r = rnd.random()
+            if r < 0.05:
+                out.append((i, t + ' (%s)' % side))
+            elif r < 0.10:
+                continue
+            else:
+                out.append((i, t))
+            if rnd.random() < 0.05:
+                j = n + len(out) + (0 if side == 'local' else 10 * n)
+                out.append((j, 'Nova zprava %d' % j))
+        return out
+
+    return base, modify('local'), modify('remote')
+
+def _translations(n, rnd):
+    base = [(i, 'Zprava %d' % i) for i in range(n)]
+
+    def modify(side):
+        return [(i, t + ' (%s)' % side if rnd.random() < 0.01 else t)
+                for i, t in base]
+
+    return base, modify('local'), modify('remote')
+
+def _reorder(n, rnd):
+    base = [(i, 'Zprava %d' % i) for i in range(n)]
+
+    def modify(side):
+        out = [(i, t + ' (%s)' % side if rnd.random() < 0.05 else t)
+                for i, t in base]
+        rnd.shuffle(out)
+        return out
+
+    return base, modify('local'), modify('remote')
+
+def _obsolete(n, rnd):
+    base = [(i, 'Zprava %d' % i) for i in range(n)]
+    local = [(i, t, None, i % 2 == 0) for i, t in base]
+    remote = [(i, t, None, i % 3 == 0) for i, t in base if i % 5]
+    return base, local, remote
+
+def _conflicts(n, rnd):
+    base = [(i, 'Zprava %d' % i) for i in range(n)]
+    local = [(i, t + ' (local)') for i, t in base]
+    remote = [(i, t + ' (remote)') for i, t in base]
+    return base, local, remote
+
+def _locations(n, rnd):
+    # few entries with n locations each
+    locations = ['src/file%d.c:%d' % (j % 31, j) for j in range(n)]
+
+    def modify(side):
+        locs = [l for l in locations if rnd.random() > 0.1]
+        locs.extend('src/%s.c:%d' % (side, j) for j in range(n // 10))
+        rnd.shuffle(locs)
+        return [(i, 'Zprava %d' % i, locs) for i in range(20)]
+
+    base = [(i, 'Zprava %d' % i, locations) for i in range(20)]
+    return base, modify('local'), modify('remote')
+
+def _headers(n, rnd):
+    # header with n keys, some changed on both sides
+    def header(side):
+        lines = [_header]
+        for j in range(n):
+            value = 'value %d' % j
+            if side != 'base' and rnd.random() < 0.2:
+                value += ' (%s)' % side
+            lines.append('"X-Key-%d: %s\\n"\n' % (j, value))
+        return ''.join(lines)
+
+    entries = [(i, 'Zprava %d' % i) for i in range(20)]
+    return [(entries, header(side)) for side in ('base', 'local', 'remote')]
+
+shapes = {
+        'edits': _edits,
+        'translations': _translations,
+        'reorder': _reorder,
+        'obsolete': _obsolete,
+        'conflicts': _conflicts,
+        'locations': _locations,
+        'headers': _headers,
+        }
+
+def make_catalogs(n, shape='edits', seed=0):
+    '''Return (base, local, remote) data of catalogs of size n.
+
+    The shapes are:
+
+     - edits: n entries, each side modifies, adds and removes about 5%
+     - translations: n entries, each side modifies about 1% of translations
+     - reorder: n entries shuffled differently on each side
+     - obsolete: n entries, half obsoleted on one and some removed and
+       a third obsoleted on the other side
+     - conflicts: n entries all changed differently on each side
+     - locations: 20 entries with n locations each, changed on each side
+     - headers: 20 entries and n header fields, some changed on each side
+    '''
+    sides = shapes[shape](n, random.Random(seed))
+    if shape == 'headers':
+        texts = [_render(e, h) for e, h in sides]
+    else:
+        texts = [_render(e) for e in sides]
+    return tuple(t.encode('utf-8') for t in texts)
+
+def pool_memory(pool):
+    """Size of the string pool itself, without the pooled values."""
+    return (sys.getsizeof(pool._ids) + sys.getsizeof(pool._values) +
+            sum(sys.getsizeof(i) for i in pool._ids.values()))
+
+def string_memory(stores, pool=None):
+    """Total size of distinct string objects held by the units of stores.
+
+    If the strings were interned, the string pool is included."""
+    seen = set()
+    total = pool_memory(pool) if pool is not None else 0
+    for store in stores:
+        for unit in store.units:
+            lists = [getattr(unit, f) for f in
+                    podiffutils._PoFileDiff._line_fields]
+            if isinstance(unit.msgstr, dict):
+                lists.extend(unit.msgstr.values())
+            else:
+                lists.append(unit.msgstr)
+            for strings in lists:
+                for s in strings:
+                    if id(s) not in seen:
+                        seen.add(id(s))
+                        total += sys.getsizeof(s)
+    return total
+
+def unit_memory(stores, pool=None):
+    """Approximate memory held by the units of stores, including strings."""
+    total = string_memory(stores, pool)
+    for store in stores:
+        for unit in store.units:
+            total += sys.getsizeof(unit) + sys.getsizeof(unit.__dict__)
+            for value in unit.__dict__.values():
+                if isinstance(value, (list, dict)):
+                    total += sys.getsizeof(value)
+                    if isinstance(value, dict):
+                        total += sum(sys.getsizeof(v) for v in value.values())
+    return total
+
+def compact_memory(catalogs, pool):
+    """Approximate memory held by compact catalogs and their string pool."""
+    total = pool_memory(pool)
+    for value in pool._values:
+        total += sys.getsizeof(value)
+        if isinstance(value, tuple):
+            for item in value:
+                if isinstance(item, tuple):
+                    total += sys.getsizeof(item)
+    # the strings inside the tuples are pooled too, so they are counted
+    for catalog in catalogs:
+        for column in (catalog.key, catalog.state) + catalog.columns:
+            total += column.buffer_info()[1] * column.itemsize
+    return total
+
+# PyPy has no sys.getsizeof, so memory can only be measured in CPython
+measure_memory = platform.python_implementation() == 'CPython'
+
+def bench_compact(texts):
+    differ = podiffutils.get_differ(pofile)()
+    start = time.time()
+    cats = [differ.load_compact(io.BytesIO(t)) for t in texts]
+    loaded = time.time()
+    out, conflicts = differ.merge_compact(*cats)
+    merged = time.time()
+    return {
+            'load': loaded - start,
+            'merge': merged - loaded,
+            'memory': (compact_memory(cats + [out], differ.strings)
+                if measure_memory else None),
+            }
+
+def bench_load(texts, jobs, compact=False, parse_cache=None):
+    """Return wall-clock time of loading texts in MergeSession."""
+    session = podiffutils.MergeSession(cache_size=0, compact=compact,
+            jobs=jobs, parse_cache=parse_cache)
+    start = time.time()
+    session.load_many([bytearray(t) for t in texts])
+    return time.time() - start
+
+def bench_prefilter(texts):
+    """Return time of merge with prefilter, or None if it falls back."""
+    differ = podiffutils.get_differ(pofile)()
+    start = time.time()
+    result = differ.merge_text(*[(t, '') for t in texts])
+    if result is None:
+        return None
+    return time.time() - start
+
+def bench_session(texts, pipeline=False):
+    """Return time of MergeSession.merge_to_string, optionally pipelined."""
+    session = podiffutils.MergeSession(cache_size=0, pipeline=pipeline)
+    start = time.time()
+    session.merge_to_string(*[bytearray(t) for t in texts])
+    return time.time() - start
+
+def bench_merge(texts, intern=True):
+    differ = podiffutils.get_differ(pofile)(intern=intern)
+    start = time.time()
+    stores = [differ.load_storage(io.BytesIO(t)) for t in texts]
+    loaded = time.time()
+    out, conflicts = differ.merge(*stores)
+    merged = time.time()
+    return {
+            'load': loaded - start,
+            'merge': merged - loaded,
+            'memory': (string_memory(stores + [out], differ.strings)
+                if measure_memory else None),
+            'units': (unit_memory(stores + [out], differ.strings)
+                if measure_memory else None),
+            }
+
+def bench_throughput(texts, repeat=5):
+    """Return entries per second of loading and of merging texts.
+
+    The best of repeat runs is taken, so that PyPy has time to compile the
+    code. The result also names the Python implementation and version."""
+    load = merge = None
+    for i in range(repeat):
+        differ = podiffutils.get_differ(pofile)()
+        start = time.time()
+        stores = [differ.load_storage(io.BytesIO(t)) for t in texts]
+        loaded = time.time()
+        differ.merge(*stores)
+        merged = time.time()
+        load = min(load or loaded - start, loaded - start)
+        merge = min(merge or merged - loaded, merged - loaded)
+    entries = sum(len(store.units) for store in stores)
+    return {
+            'python': '%s %s' % (platform.python_implementation(),
+                platform.python_version()),
+            'load': entries / max(load, 1e-6),
+            'merge': entries / max(merge, 1e-6),
+            }
+
+def interpreter_throughput(interpreter, size, shape):
+    """Run bench_throughput in another Python interpreter."""
+    output = subprocess.check_output([interpreter, __file__, '--throughput',
+        '-n', str(size), '-s', shape])
+    return json.loads(output.decode('utf-8'))
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--size', type=int, default=10000,
+            help='number of entries in generated catalogs')
+    parser.add_argument('-j', '--jobs', type=int, default=3,
+            help='number of processes for parallel loading')
+    parser.add_argument('-s', '--shape', default='edits',
+            choices=sorted(shapes),
+            help='kind of changes in generated catalogs')
+    parser.add_argument('-i', '--interpreter', dest='interpreters',
+            action='append', default=[], metavar='PYTHON',
+            help='also measure merge throughput with PYTHON, e.g. pypy3; '
+            'can be repeated')
+    parser.add_argument('--throughput', action='store_true',
+            help='only measure merge throughput and print it as JSON')
+    args = parser.parse_args()
+
+    texts = make_catalogs(args.size, args.shape)
+    if args.throughput:
+        print(json.dumps(bench_throughput(texts)))
+        return
+
+    print('merge throughput in entries/s:')
+    results = [bench_throughput(texts)] + [
+            interpreter_throughput(i, args.size, args.shape)
+            for i in args.interpreters]
+    for res in results:
+        print('%-24s load %9.0f  merge %9.0f' % (
+            res['python'], res['load'], res['merge']))
+    plain = bench_merge(texts, intern=False)
+    interned = bench_merge(texts, intern=True)
+    for name, res in (('plain', plain), ('interned', interned)):
+        line = '%-10s load %7.3fs  merge %7.3fs' % (
+                name, res['load'], res['merge'])
+        if measure_memory:
+            line += '  strings %10d B' % res['memory']
+        print(line)
+    if measure_memory:
+        print('interning saved %d B (%.0f%%) of string memory' % (
+            plain['memory'] - interned['memory'],
+            100.0 * (plain['memory'] - interned['memory']) / plain['memory']))
+
+    prefilter = bench_prefilter(texts)
+    if prefilter is None:
+        print('prefilter  falls back to full merge')
+    else:
+        print('prefilter  load and merge %7.3fs' % prefilter)
+
+    print('merge to string: sequential %7.3fs  pipelined %7.3fs' % (
+        bench_session(texts), bench_session(texts, pipeline=True)))
+
+    compact = bench_compact(texts)
+    print('%-10s load %7.3fs  merge %7.3fs' % (
+        'compact', compact['load'], compact['merge']))
+    if measure_memory:
+        print('catalogs take %d B as units and %d B in compact form '
+                '(%.1fx less)' % (interned['units'], compact['memory'],
+                    float(interned['units']) / compact['memory']))
+
+    for compact in (False, True):
+        sequential = bench_load(texts, 1, compact)
+        parallel = bench_load(texts, args.jobs, compact)
+        print('loading %s: sequential %7.3fs  %d jobs %7.3fs  '
+                '(%.1fx faster on %d cpus)' % (
+                    'compact' if compact else 'units',
+                    sequential, args.jobs, parallel, sequential / parallel,
+                    multiprocessing.cpu_count()))
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = podiffutils.ParseCache(directory)
+        bench_load(texts, 1, False, cache)
+        for compact in (False, True):
+            print('loading %s from parse cache: %7.3fs' % (
+                'compact' if compact else 'units',
+                bench_load(texts, 1, compact, cache)))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
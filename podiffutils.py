@@ -35,14 +35,60 @@ accepted resolution to work on.
 #########################################################################
 # The implementation classes, to become translate.tools.difutils
 
+from array import array
+from collections import OrderedDict
 from copy import deepcopy
+import bz2
 import difflib
+import errno
+import gzip
+import hashlib
+import io
 from itertools import chain
+import marshal
+import multiprocessing
+import os
+import random
 import re
+import stat
+import struct
+import sys
+import threading
 import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+if sys.version_info[0] >= 3:
+    unicode = str
+    xrange = range
+
+# Catalog content given to MergeSession. In Python 2, str (which is bytes)
+# are file names, so only bytearray can be content there.
+if sys.version_info[0] >= 3:
+    _buffer_types = (bytes, bytearray, memoryview)
+else:
+    _buffer_types = (bytearray,)
+
+def _array_bytes(a):
+    # tostring is called tobytes since Python 3.2 and gone since 3.9
+    if hasattr(a, 'tobytes'):
+        return a.tobytes()
+    return a.tostring()
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 from translate.misc.multistring import multistring
-from translate.storage import poheader, pypo
+from translate.storage import mo, poheader, pypo
+from translate import __version__ as toolkit_version
 
 class _Item(object):
     """Auxiliary class that holds info about merging state"""
@@ -70,6 +116,15 @@ class _Item3(_Item):
         self.local = None
         self.remote = None
 
+class _ItemN(_Item):
+    """Class holding base and any number of other units for N-way merge"""
+    __slots__ = ('base', 'sides')
+
+    def __init__(self, n):
+        super(_ItemN, self).__init__()
+        self.base = None
+        self.sides = [None] * n
+
 class _Walker(object):
     """Helper for complex iteration over iterable.
 
@@ -97,6 +152,156 @@ class _Walker(object):
                 self._current = None
                 self._valid = False
 
+class _StringPool(object):
+    """Keeps single copy of each distinct string.
+
+    Base, local and remote catalogs share most of their strings, so storing
+    each of them only once saves close to half of the memory the strings
+    need, including the pool itself. Each pooled value also gets a small
+    integer id, which is what _CompactCatalog stores. Any hashable immutable
+    value can be pooled, the compact catalogs pool tuples of lines too."""
+    __slots__ = ('_ids', '_values')
+
+    def __init__(self):
+        self._ids = {}
+        self._values = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def id(self, value):
+        i = self._ids.get(value)
+        if i is None:
+            i = self._ids[value] = len(self._values)
+            self._values.append(value)
+        return i
+
+    def get(self, i):
+        return self._values[i]
+
+    def intern(self, string):
+        return self._values[self.id(string)]
+
+    def intern_list(self, strings):
+        strings[:] = [self.intern(s) for s in strings]
+
+    def __getstate__(self):
+        return self._values
+
+    def __setstate__(self, values):
+        self._values = values
+        self._ids = dict((v, i) for i, v in enumerate(values))
+
+class _CompactCatalog(object):
+    """Catalog stored as struct of arrays.
+
+    Each entry is represented by the same position in several parallel
+    arrays holding ids from a _StringPool shared by all catalogs of one
+    differ, so entries with equal fields share the values and can be
+    compared by id. This takes several times less memory than translation
+    units. Which fields there are is up to the differ that converts units
+    to and from this form."""
+
+    OBSOLETE = 1
+    FUZZY = 2
+    HEADER = 4
+    PLURAL = 8
+
+    def __init__(self, nfields, filename=None, encoding=None):
+        self.filename = filename
+        self.encoding = encoding
+        self.key = array('i')
+        self.state = array('B')
+        self.columns = tuple(array('i') for i in range(nfields))
+
+    def __len__(self):
+        return len(self.key)
+
+    def append(self, key, state, values):
+        self.key.append(key)
+        self.state.append(state)
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def append_from(self, other, index):
+        self.append(other.key[index], other.state[index], other.values(index))
+
+    def values(self, index):
+        return tuple(column[index] for column in self.columns)
+
+    def copy(self):
+        other = _CompactCatalog(0, self.filename, self.encoding)
+        other.key = array('i', self.key)
+        other.state = array('B', self.state)
+        other.columns = tuple(array('i', column) for column in self.columns)
+        return other
+
+    def repool(self, old, new):
+        """Move the catalog from string pool old to string pool new."""
+        self.key = array('i', [new.id(old.get(i)) for i in self.key])
+        self.columns = tuple(array('i', [new.id(old.get(i)) for i in column])
+                for column in self.columns)
+
+    def handles(self, side):
+        """Return iterable of entry handles for SetMatcher3.
+
+        The handle encodes the index and given side number (0 to 3) in an
+        int, so the catalog does not need to keep an object per entry."""
+        return _Handles(side, len(self))
+
+class _Handles(object):
+    __slots__ = ('side', 'size')
+
+    def __init__(self, side, size):
+        self.side = side
+        self.size = size
+
+    def __iter__(self):
+        side = self.side
+        return (i << 2 | side for i in xrange(self.size))
+
+class _SimilarityIndex(object):
+    """Finds whether a string resembles any of many strings.
+
+    Comparing the string with all of them would make pruning obsolete
+    entries quadratic, so only the strings sharing the most of its rarest
+    words are compared with difflib. Words common to many strings are only
+    looked up in some of them, so the result is approximate."""
+    __slots__ = ('_strings', '_words')
+
+    rare_words = 3
+    max_posting = 100
+    candidates = 10
+
+    def __init__(self, strings):
+        self._strings = []
+        self._words = {}
+        for i, string in enumerate(strings):
+            self._strings.append(string)
+            for word in self._split(string):
+                self._words.setdefault(word, []).append(i)
+
+    @staticmethod
+    def _split(string):
+        return set(re.findall(r'\w+', string.lower(), re.UNICODE))
+
+    def resembles(self, string, ratio):
+        postings = sorted((self._words[w] for w in self._split(string)
+                if w in self._words), key=len)
+        counts = {}
+        for posting in postings[:self.rare_words]:
+            for i in posting[:self.max_posting]:
+                counts[i] = counts.get(i, 0) + 1
+        best = sorted(counts, key=counts.get, reverse=True)
+        matcher = difflib.SequenceMatcher(None, b=string)
+        for i in best[:self.candidates]:
+            matcher.set_seq1(self._strings[i])
+            if (matcher.real_quick_ratio() >= ratio and
+                    matcher.quick_ratio() >= ratio and
+                    matcher.ratio() >= ratio):
+                return True
+        return False
+
 class _SetMatcherBase:
     """Utilities for use with SetMatcher[23]"""
     def _fill_item_map(self, field, units):
@@ -139,7 +344,7 @@ class SetMatcher2(_SetMatcherBase):
                     self.deletedfunc(i.old) and
                     not self.deletedfunc(i.new))
 
-        while ow.valid() and nw.valid():
+        while ow.valid() or nw.valid():
             # we emit new units that don't exist in old if all preceeding
             # units were already emitted
             if nw.valid() and not_old(nw.get()):
@@ -164,7 +369,7 @@ class SetMatcher2(_SetMatcherBase):
         # verify we processed everything
         assert not ow.valid()
         assert not nw.valid()
-        assert not [i for i in self.item_map.itervalues() if not i.done]
+        assert not [i for i in self.item_map.values() if not i.done]
 
 class SetMatcher3(_SetMatcherBase):
     """Takes three sets and generates set of tripples to be merged together,
@@ -231,7 +436,123 @@ class SetMatcher3(_SetMatcherBase):
         assert not lw.valid()
         assert not rw.valid()
         assert not bw.valid()
-        assert not [i for i in self.item_map.itervalues() if not i.done]
+        assert not [i for i in self.item_map.values() if not i.done]
+
+class SetMatcherN(_SetMatcherBase):
+    """Takes base and any number of other sets and generates tuples (base,
+    side1, side2, ...) to be merged together, trying to preserve ordering
+    as much as possible.
+
+    The order of the first side is preferred like the order of local is by
+    SetMatcher3; units not in it are inserted where they are in the other
+    sides."""
+
+    def __init__(self, base, sides, keyfunc = (lambda x: x),
+            deletedfunc = (lambda x: False)):
+        self.base = base
+        self.sides = list(sides)
+        self.keyfunc = keyfunc
+        self.deletedfunc = deletedfunc
+        self.item_map = dict()
+        n = len(self.sides)
+        self.item_type = lambda: _ItemN(n)
+
+    def _fill_sides(self):
+        for k, units in enumerate(self.sides):
+            for unit in units:
+                key = self.keyfunc(unit)
+                if key in self.item_map:
+                    item = self.item_map[key]
+                else:
+                    item = self.item_type()
+                    self.item_map[key] = item
+                item.sides[k] = unit
+
+    def match(self):
+        self._fill_item_map('base', self.base)
+        self._fill_sides()
+
+        bw = _Walker(self.base)
+        walkers = [_Walker(side) for side in self.sides]
+
+        def not_first(item, k):
+            first = item.sides[0]
+            return first is None or (
+                    self.deletedfunc(first) and
+                    not self.deletedfunc(item.sides[k]))
+
+        while any(w.valid() for w in walkers):
+            # we emit units that don't exist in the first side if all
+            # preceeding units were already emitted, otherwise in order
+            # they appear in the first side
+            for k, w in enumerate(walkers):
+                if k and w.valid() and not_first(self._item(w.get()), k):
+                    break
+            else:
+                w = walkers[0]
+                if not w.valid():
+                    w = [w for w in walkers if w.valid()][0]
+            i = self._item(w.get())
+            assert not i.done
+            yield (i.base,) + tuple(i.sides)
+            i.done = True
+            w.next()
+            # and skip emitted units in all iterators
+            for w in walkers:
+                while w.valid() and self._item(w.get()).done:
+                    w.next()
+
+        # emit remaining units from base
+        while bw.valid():
+            i = self._item(bw.get())
+            if not i.done:
+                yield (i.base,) + tuple(i.sides)
+                i.done = True
+            bw.next()
+
+        # verify we processed everything
+        assert not [i for i in self.item_map.values() if not i.done]
+
+class MergeObserver(object):
+    """Base class for observers of merge decisions.
+
+    Set an instance as observer attribute of DiffUtils to have its methods
+    called at decision points of the merge, e.g. to collect statistics or
+    trace slow units. The methods here do nothing, override the interesting
+    ones. Without observer the merge only pays a None check per decision.
+
+    The methods are described for the 3-way merge. DiffUtils.merge_many
+    does not call unit_begin and unit_end, its target decisions are
+    'unchanged', 'changed', 'same', 'quality' and 'conflict' and the header
+    winner is name of the side."""
+
+    def unit_begin(self, base, local, remote):
+        """Called before merging a unit. Any argument may be None."""
+
+    def unit_end(self, result, conflicts):
+        """Called after merging a unit with the result and conflict count."""
+
+    def unit_decision(self, decision):
+        """Called with how the unit is merged.
+
+        The decision is one of 'created', 'deleted', 'deleted-both',
+        'merged' (all three units exist) and 'copied' (the same in local and
+        remote, by merge_compact)."""
+
+    def target_decision(self, unit, decision):
+        """Called with where the translation of unit was taken from.
+
+        The decision is 'local' or 'remote' when only that side changed,
+        'same' when both did the same change, 'local-quality' or
+        'remote-quality' when the conflict was resolved by preferring the
+        translated over fuzzy over untranslated, and 'conflict'."""
+
+    def header_decision(self, key, rule, winner):
+        """Called for each header field with which side's value was used.
+
+        The rule is None when the field changed on at most one side or
+        the same on both, otherwise the header field by which date the
+        conflict was resolved ('POT-Creation-Date' or 'PO-Revision-Date')."""
 
 class DiffUtils:
     """Abstract base class for differs. Implements comparing and merging
@@ -240,18 +561,56 @@ class DiffUtils:
     Some implementation details depend on specific storage class. Correct
     implementation can be obtained from get_differ."""
 
-    # FIXME: Take options in __init__
+    # FIXME: Take more options in __init__
+
+    def __init__(self, intern=True, max_obsolete=None,
+            obsolete_similarity=None):
+        if max_obsolete is not None and max_obsolete < 0:
+            raise ValueError('max_obsolete must not be negative, got %d' % (
+                max_obsolete,))
+        if obsolete_similarity is not None and not (
+                0 <= obsolete_similarity <= 1):
+            raise ValueError('obsolete_similarity must be between 0 and 1, '
+                    'got %r' % (obsolete_similarity,))
+        self.strings = _StringPool() if intern else None
+        # list to which conflicts are recorded, or None
+        self.conflict_index = None
+        # MergeObserver or None
+        self.observer = None
+        # merge keeps at most this many obsolete entries, None for all
+        self.max_obsolete = max_obsolete
+        # if set, merge only keeps obsolete entries whose id resembles id of
+        # some normal entry with at least this difflib ratio
+        self.obsolete_similarity = obsolete_similarity
 
     def load_storage(self, storefile):
-        store = pypo.pofile.parsefile(storefile)
+        store = pypo.pofile.parsefile(_named_stream(*_read_catalog(storefile)))
         if not isinstance(store, self.FileClass):
             raise ValueError('All files have to be in format the same format %s, but %s is in %s' % (
                 self.FileClass.Name, store.filename, store.Name))
+        self.intern_store(store)
         return store
 
+    def intern_store(self, store):
+        """Replace strings in store with shared copies.
+
+        Does nothing if the differ was created with interning disabled."""
+        if self.strings is not None:
+            for unit in store.units:
+                self.intern_unit(unit)
+
+    # abstract intern_unit(self, unit)
+
     # todo load_patch
 
-    def merge(self, base, local, remote):
+    def merge(self, base, local, remote, sink=None):
+        """3-way merge stores. Returns merged store and number of conflicts.
+
+        If sink is given, it is called with (rank, unit) for each unit of
+        the result as soon as it is final, with rank 0 for the header, 1 for
+        normal and 2 for obsolete entries. Units of each rank come in the
+        order of the result, so the caller can process them while the merge
+        goes on."""
         out = self.FileClass()
         conflicts = 0
         del out.units[:] # delete header; we'll create it if the inputs have it
@@ -261,30 +620,267 @@ class DiffUtils:
         headers = []
         normal = []
         obsolete = []
+        observer = self.observer
+        if sink is None:
+            sink = lambda rank, unit: None
         for bu, lu, ru in matcher.match():
+            if observer is not None:
+                observer.unit_begin(bu, lu, ru)
             u, c = self.merge_unit(bu, lu, ru)
+            if observer is not None:
+                observer.unit_end(u, c)
             if u is not None:
                 assert isinstance(u, out.UnitClass)
                 if u.isheader():
                     headers.append(u)
+                    sink(0, u)
                 elif u.isobsolete():
                     obsolete.append(u)
                 else:
                     normal.append(u)
+                    sink(1, u)
             conflicts += c
+        obsolete = self.prune_obsolete(normal, obsolete,
+                lambda u: unicode(u.getid()))
+        for u in obsolete:
+            sink(2, u)
         # the set matcher might occasionally produce incorrect order, so
         # force it
         for u in chain(headers, normal, obsolete):
             out.addunit(u)
+        self.intern_store(out)
         return out, conflicts
 
+    def prune_obsolete(self, normal, obsolete, idfunc):
+        """Return the obsolete entries merge should keep.
+
+        Applies the max_obsolete and obsolete_similarity options. The first
+        entries are kept, because the merge puts entries that were just
+        made obsolete first. The idfunc returns id of an entry as string."""
+        if self.obsolete_similarity is not None and obsolete:
+            index = _SimilarityIndex(idfunc(e) for e in normal)
+            obsolete = [e for e in obsolete
+                    if index.resembles(idfunc(e), self.obsolete_similarity)]
+        if self.max_obsolete is not None:
+            obsolete = obsolete[:self.max_obsolete]
+        return obsolete
+
+    def merge_bases(self, bases, compact=False):
+        """Merge several merge bases to one virtual base.
+
+        With criss-cross history there is more than one best common
+        ancestor. Like git's recursive strategy, they are merged in turn,
+        here with empty catalog as their base, so entries that differ
+        between them end up conflicted in the virtual base. The bases are
+        compact catalogs if compact is set. Conflicts of this merge are not
+        recorded and not reported to the observer and obsolete entries are
+        not pruned from the virtual base, because that would make entries
+        look newly created in the final merge."""
+        empty = self.FileClass()
+        del empty.units[:]
+        if compact:
+            merge, empty = self.merge_compact, self.compact_catalog(empty)
+        else:
+            merge = self.merge
+        saved = (self.conflict_index, self.observer, self.max_obsolete,
+                self.obsolete_similarity)
+        self.conflict_index = self.observer = None
+        self.max_obsolete = self.obsolete_similarity = None
+        try:
+            base = bases[0]
+            for other in bases[1:]:
+                base, conflicts = merge(empty, base, other)
+        finally:
+            (self.conflict_index, self.observer, self.max_obsolete,
+                    self.obsolete_similarity) = saved
+        return base
+
+    def update(self, store, template):
+        """Update catalog from template like msgmerge does.
+
+        Entries are matched by id. Source-side information is taken from the
+        template, translations are kept, new entries are added untranslated
+        and entries not in the template are made obsolete. The store is
+        modified in place, the template is not modified, so it can be used
+        for many stores. Returns the store."""
+        matcher = SetMatcher2(template.units, store.units,
+                keyfunc=template.UnitClass.getid,
+                deletedfunc=template.UnitClass.isobsolete)
+        headers = []
+        normal = []
+        obsolete = []
+        for tu, u in matcher.match():
+            if tu is not None and tu.isobsolete():
+                tu = None # obsolete entries in template don't count
+            if u is None:
+                if tu is None:
+                    continue
+                u = self.new_unit(tu)
+            elif tu is not None:
+                self.update_unit(u, tu)
+            elif not u.isheader() and not u.isobsolete():
+                u.makeobsolete()
+            if u.isheader():
+                headers.append(u)
+            elif u.isobsolete():
+                obsolete.append(u)
+            else:
+                normal.append(u)
+        store.units = []
+        for u in chain(headers, normal, obsolete):
+            store.addunit(u)
+        return store
+
+    # abstract new_unit(self, template)
+
+    # abstract update_unit(self, unit, template)
+
+    def load_compact(self, storefile):
+        """Load storefile to _CompactCatalog.
+
+        The catalog uses the string pool of this differ, so it can only be
+        merged by it."""
+        if self.strings is None:
+            raise ValueError('Compact catalogs need differ with interning')
+        return self.compact_catalog(self.load_storage(storefile))
+
+    def merge_compact(self, base, local, remote):
+        """Merge compact catalogs.
+
+        Works like merge, but the result is _CompactCatalog too. Entries are
+        only converted to units when they differ between local and remote,
+        entries that are the same are copied verbatim."""
+        cats = (base, local, remote)
+        stubs = [None, None, None]
+        def unit(handle):
+            if handle is None:
+                return None
+            side = handle & 3
+            if stubs[side] is None:
+                stubs[side] = self.stub_store(cats[side])
+            return self.expand_unit(cats[side], handle >> 2, stubs[side])
+        def keyfunc(handle):
+            return cats[handle & 3].key[handle >> 2]
+        def deletedfunc(handle):
+            return cats[handle & 3].state[handle >> 2] & _CompactCatalog.OBSOLETE
+
+        out = _CompactCatalog(len(local.columns), local.filename,
+                local.encoding)
+        conflicts = 0
+        matcher = SetMatcher3(base.handles(0), local.handles(1),
+                remote.handles(2), keyfunc=keyfunc, deletedfunc=deletedfunc)
+        headers = []
+        normal = []
+        obsolete = []
+        # the result entries are collected as (catalog, index) pairs and
+        # the entries that had to be merged are put in a scratch catalog
+        merged = _CompactCatalog(len(local.columns))
+        observer = self.observer
+        for bh, lh, rh in matcher.match():
+            if (lh is not None and rh is not None
+                    and local.state[lh >> 2] == remote.state[rh >> 2]
+                    and not local.state[lh >> 2] & _CompactCatalog.HEADER
+                    and local.values(lh >> 2) == remote.values(rh >> 2)):
+                if observer is not None:
+                    observer.unit_decision('copied')
+                cat, index = local, lh >> 2
+            else:
+                bu, lu, ru = unit(bh), unit(lh), unit(rh)
+                if observer is not None:
+                    observer.unit_begin(bu, lu, ru)
+                u, c = self.merge_unit(bu, lu, ru)
+                if observer is not None:
+                    observer.unit_end(u, c)
+                conflicts += c
+                if u is None:
+                    continue
+                self.compact_append(merged, u)
+                cat, index = merged, len(merged) - 1
+            state = cat.state[index]
+            if state & _CompactCatalog.HEADER:
+                headers.append((cat, index))
+            elif state & _CompactCatalog.OBSOLETE:
+                obsolete.append((cat, index))
+            else:
+                normal.append((cat, index))
+        obsolete = self.prune_obsolete(normal, obsolete,
+                lambda entry: self.strings.get(entry[0].key[entry[1]]))
+        for cat, index in chain(headers, normal, obsolete):
+            out.append_from(cat, index)
+        return out, conflicts
+
+    def stat(self, old, new):
+        """Count changes between two versions of compact catalog.
+
+        Returns dict with numbers of entries 'added' and 'removed' (made
+        obsolete counts as removed), entries with 'changed' translation
+        and entries that became 'fuzzied' or 'translated'. The order does
+        not matter for the counts, so entries are simply joined by key."""
+        skip = _CompactCatalog.OBSOLETE | _CompactCatalog.HEADER
+        fuzzy = _CompactCatalog.FUZZY
+        old_index = {}
+        for i, key in enumerate(old.key):
+            if not old.state[i] & skip:
+                old_index[key] = i
+        counts = dict.fromkeys(('added', 'removed', 'changed', 'fuzzied',
+            'translated'), 0)
+        matched = 0
+        for i, key in enumerate(new.key):
+            state = new.state[i]
+            if state & skip:
+                continue
+            j = old_index.get(key)
+            if j is None:
+                counts['added'] += 1
+                continue
+            matched += 1
+            translation = self.compact_translation(new, i)
+            old_translation = self.compact_translation(old, j)
+            was_fuzzy = old.state[j] & fuzzy
+            if translation != old_translation:
+                counts['changed'] += 1
+            if state & fuzzy and not was_fuzzy:
+                counts['fuzzied'] += 1
+            if (translation is not None and not state & fuzzy and
+                    (old_translation is None or was_fuzzy)):
+                counts['translated'] += 1
+        counts['removed'] = len(old_index) - matched
+        return counts
+
+    # abstract compact_translation(self, catalog, index)
+
     def clone_unit(self, unit):
         return deepcopy(unit)
 
     # abstract empty_unit(self, template)
 
+    # abstract serialize(self, store, conflict_index=None)
+
+    def record_conflict(self, unit, kind, **details):
+        """Record conflict in unit to conflict_index if it is set.
+
+        The kind is 'translation' or 'header'. The record is a dict that
+        gets the line of the unit when the output is serialized."""
+        if self.conflict_index is not None:
+            details.update(kind=kind, id=unit.getid(),
+                    msgctxt=unit.getcontext(),
+                    msgid=unicode(unit.source), line=None)
+            self.conflict_index.append(details)
+
+    # abstract compact_catalog(self, store)
+
+    # abstract compact_append(self, catalog, unit)
+
+    # abstract expand_unit(self, catalog, index, store=None)
+
+    # abstract expand_catalog(self, catalog)
+
+    # abstract stub_store(self, catalog)
+
     # abstract _merge_unit(self, base, local, remote)
 
+    # abstract _merge_unit_many(self, base, sides, names)
+
     def merge_unit(self, base, local, remote):
         # Handle deletion and creation generically.
         # This only concerns the case where the unit does not exist at all;
@@ -292,18 +888,29 @@ class DiffUtils:
         # obsolete as just another property!
         # FIXME: Special treatment for header needed!
         assert base is not None or local is not None or remote is not None
+        observer = self.observer
         if base is None: # creation
+            if observer is not None:
+                observer.unit_decision('created')
             if remote is None:
                 return self.clone_unit(local), 0
             if local is None:
                 return self.clone_unit(remote), 0
             return self._merge_unit(self.empty_unit(local), local, remote)
+        if local is None and remote is None: # deleted on both sides
+            if observer is not None:
+                observer.unit_decision('deleted-both')
+            return None, 0
         if remote is None: # deletion
+            if observer is not None:
+                observer.unit_decision('deleted')
             u = self.clone_unit(local)
             if not base.isobsolete():
                 u.makeobsolete() # only if not resurrected in local
             return u, 0
         if local is None:
+            if observer is not None:
+                observer.unit_decision('deleted')
             u = self.clone_unit(remote)
             if not base.isobsolete():
                 u.makeobsolete()
@@ -311,6 +918,8 @@ class DiffUtils:
         # None of them is None. They can be obsolete, but that has to be
         # handled as part of translation handling while comments and stuff
         # still need to be merged.
+        if observer is not None:
+            observer.unit_decision('merged')
         return self._merge_unit(base, local, remote)
 
     def merge_simple(self, base, local, remote):
@@ -338,6 +947,104 @@ class DiffUtils:
         return [o for o in (self.merge_simple(b, l, r) for b, l, r in
             matcher.match()) if o is not None]
 
+    def merge_many(self, base, sides):
+        """N-way merge of list of stores with common base.
+
+        Works like merge with local and remote replaced by any number of
+        sides, so several branches can be merged in one pass. Conflicting
+        translations list all the sides that changed them."""
+        out = self.FileClass()
+        conflicts = 0
+        del out.units[:]
+        matcher = SetMatcherN(base.units, [side.units for side in sides],
+                keyfunc=base.UnitClass.getid,
+                deletedfunc=base.UnitClass.isobsolete)
+        headers = []
+        normal = []
+        obsolete = []
+        names = self.side_names(sides)
+        for units in matcher.match():
+            u, c = self.merge_unit_many(units[0], units[1:], names)
+            if u is not None:
+                if u.isheader():
+                    headers.append(u)
+                elif u.isobsolete():
+                    obsolete.append(u)
+                else:
+                    normal.append(u)
+            conflicts += c
+        obsolete = self.prune_obsolete(normal, obsolete,
+                lambda u: unicode(u.getid()))
+        for u in chain(headers, normal, obsolete):
+            out.addunit(u)
+        self.intern_store(out)
+        return out, conflicts
+
+    def side_names(self, stores):
+        """Return names of stores for conflict markers of merge_many.
+
+        Stores without filename are called like in merge, local for the
+        first one and remote for the others."""
+        if len(stores) == 2:
+            defaults = ['local', 'remote']
+        else:
+            defaults = ['local'] + ['remote %d' % k
+                    for k in range(1, len(stores))]
+        return [_getname(store, default)
+                for store, default in zip(stores, defaults)]
+
+    def merge_unit_many(self, base, sides, names):
+        """Merge unit like merge_unit, but from any number of sides.
+
+        The names are names of the sides from side_names."""
+        assert base is not None or any(u is not None for u in sides)
+        observer = self.observer
+        present = [k for k, u in enumerate(sides) if u is not None]
+        deleted = len(present) < len(sides)
+        if deleted:
+            sides = [sides[k] for k in present]
+            names = [names[k] for k in present]
+        if base is None: # creation
+            if observer is not None:
+                observer.unit_decision('created')
+            if len(sides) == 1:
+                return self.clone_unit(sides[0]), 0
+            return self._merge_unit_many(self.empty_unit(sides[0]), sides,
+                    names)
+        if not sides: # deleted on all sides
+            if observer is not None:
+                observer.unit_decision('deleted-both')
+            return None, 0
+        if deleted:
+            if observer is not None:
+                observer.unit_decision('deleted')
+            if len(sides) == 1:
+                u, c = self.clone_unit(sides[0]), 0
+            else:
+                u, c = self._merge_unit_many(base, sides, names)
+            if not base.isobsolete():
+                u.makeobsolete() # only if not resurrected
+            return u, c
+        if observer is not None:
+            observer.unit_decision('merged')
+        return self._merge_unit_many(base, sides, names)
+
+    def merge_simple_many(self, base, sides):
+        """Merges scalar that cannot conflict like merge_simple."""
+        changed = set(value for value in sides if value != base)
+        if not changed:
+            return base
+        if len(changed) == 1:
+            return changed.pop()
+        raise ValueError("merge_simple_many does not handle conflicts (%r, %r)" % (
+            base, sides))
+
+    def merge_list_many(self, base, sides):
+        "Merges list as set like merge_list, but from any number of sides."
+        matcher = SetMatcherN(base, sides)
+        return [o for o in (self.merge_simple_many(m[0], m[1:]) for m in
+            matcher.match()) if o is not None]
+
 def _getname(store, default):
     if hasattr(store, 'filename') and store.filename:
         return store.filename
@@ -349,9 +1056,443 @@ def _getname(store, default):
 class _PoFileDiff(DiffUtils):
     FileClass = pypo.pofile
 
+    # all the pounit attributes holding lists of (quoted) lines
+    _line_fields = (
+            'othercomments', 'automaticcomments', 'sourcecomments',
+            'typecomments', 'msgidcomments', 'msgid_pluralcomments',
+            'prev_msgctxt', 'prev_msgid', 'prev_msgid_plural',
+            'msgctxt', 'msgid', 'msgid_plural',
+            )
+
+    def new_unit(self, template):
+        unit = type(template)()
+        unit.msgctxt = list(template.msgctxt)
+        unit.msgid = list(template.msgid)
+        unit.msgid_plural = list(template.msgid_plural)
+        if isinstance(template.msgstr, dict):
+            unit.msgstr = dict((i, list(l))
+                    for i, l in template.msgstr.items())
+        else:
+            unit.msgstr = list(template.msgstr)
+        unit.othercomments = list(template.othercomments)
+        if template.isheader():
+            unit.typecomments = list(template.typecomments)
+        self.update_unit(unit, template)
+        return unit
+
+    def update_unit(self, unit, template):
+        if unit.isheader():
+            self._update_header(unit, template)
+            return
+        if unit.isobsolete():
+            unit.resurrect()
+        unit.sourcecomments = list(template.sourcecomments)
+        unit.automaticcomments = list(template.automaticcomments)
+        fuzzy = unit.isfuzzy()
+        if template.hasplural() != unit.hasplural():
+            if template.hasplural():
+                unit.msgstr = {0: unit.msgstr}
+            else:
+                unit.msgstr = unit.msgstr[0]
+            fuzzy = fuzzy or not unit.isblank()
+        unit.msgid = list(template.msgid)
+        unit.msgid_plural = list(template.msgid_plural)
+        unit.msgid_pluralcomments = list(template.msgid_pluralcomments)
+        # fuzzy goes first like msgmerge does it
+        self._set_types(unit,
+                (['fuzzy'] if fuzzy else []) + self._get_types(template))
+        unit.markfuzzy(fuzzy)
+
+    def _update_header(self, unit, template):
+        date = poheader.parseheaderstring(template.target).get(
+                'POT-Creation-Date')
+        header = poheader.parseheaderstring(unit.target)
+        if date and header.get('POT-Creation-Date') != date:
+            header['POT-Creation-Date'] = date
+            unit.target = ''.join('%s: %s\n' % (key, value)
+                    for key, value in header.items())
+
+    def get_encoding(self, store):
+        """Return encoding of store.
+
+        Translate Toolkit 2 and later have encoding property, the older
+        versions only the _encoding attribute."""
+        if isinstance(getattr(type(store), 'encoding', None), property):
+            return store.encoding
+        return getattr(store, '_encoding', 'UTF-8')
+
+    def set_encoding(self, store, encoding):
+        if isinstance(getattr(type(store), 'encoding', None), property):
+            store.encoding = encoding
+        else:
+            store._encoding = encoding
+            for unit in store.units:
+                unit._encoding = encoding
+
+    def render_unit(self, unit):
+        """Return the text of unit in serialized store."""
+        return unit._getoutput() + u"\n"
+
+    def serialize(self, store, conflict_index=None, rendered=None):
+        """Convert store to string like str(store) does.
+
+        Fills in lines of units in the conflict_index records while at it.
+        The rendered list may give render_unit results for the units of
+        store that were computed beforehand."""
+        conflicts = {}
+        for record in conflict_index or ():
+            conflicts.setdefault(record['id'], []).append(record)
+        if rendered is None:
+            rendered = [self.render_unit(unit) for unit in store.units]
+        chunks = []
+        line = 1
+        for unit, chunk in zip(store.units, rendered):
+            if conflicts:
+                for record in conflicts.get(unit.getid(), ()):
+                    record['line'] = line
+            line += chunk.count(u"\n")
+            chunks.append(chunk)
+        output = u"".join(chunks).rstrip()
+        if output:
+            output += u"\n"
+        try:
+            return output.encode(self.get_encoding(store))
+        except UnicodeEncodeError:
+            # Switch the store to UTF-8 like str(store) does. That adds a
+            # header line, so the lines have to be counted again.
+            store.updateheader(add=True,
+                    Content_Type="text/plain; charset=UTF-8")
+            self.set_encoding(store, "UTF-8")
+            return self.serialize(store, conflict_index)
+
+    def compile_mo(self, store):
+        """Return MO file data of store like msgfmt creates them.
+
+        Fuzzy, obsolete and untranslated entries are left out like msgfmt
+        does, the header is always included. The strings are encoded in the
+        charset of the catalog. The hash table lets the gettext runtime
+        look messages up without binary search."""
+        encoding = self.get_encoding(store)
+        messages = {}
+        for unit in store.units:
+            if not (unit.istranslated() or unit.isheader()):
+                continue
+            if unit.hasplural():
+                key = u'\0'.join(unit.source.strings)
+                value = u'\0'.join(unit.target.strings)
+            else:
+                key = unicode(unit.source)
+                value = unicode(unit.target)
+            context = unit.getcontext()
+            if context:
+                key = context + u'\x04' + key
+            messages[key.encode(encoding)] = value.encode(encoding)
+
+        # the keys must be sorted for binary search
+        keys = sorted(messages)
+        count = len(keys)
+        # gettext uses the smallest prime at least 4/3 of the count and
+        # hashes the msgid without the plural
+        hash_size = max(mo.get_next_prime_number(count * 4 // 3), 3)
+        hash_table = array('I', [0]) * hash_size
+        for i, key in enumerate(keys):
+            value = mo.hashpjw(key.split(b'\0')[0])
+            cursor = value % hash_size
+            increment = 1 + value % (hash_size - 2)
+            while hash_table[cursor]:
+                cursor = (cursor + increment) % hash_size
+            hash_table[cursor] = i + 1
+
+        key_index = array('I')
+        value_index = array('I')
+        offset = 7 * 4 + 16 * count + 4 * hash_size
+        for key in keys:
+            key_index.extend((len(key), offset))
+            offset += len(key) + 1
+        for key in keys:
+            value_index.extend((len(messages[key]), offset))
+            offset += len(messages[key]) + 1
+        header = struct.pack('Iiiiiii',
+                0x950412de,             # magic
+                0,                      # version
+                count,
+                7 * 4,                  # offset of key index
+                7 * 4 + 8 * count,      # offset of value index
+                hash_size,
+                7 * 4 + 16 * count)     # offset of hash table
+        return b''.join([header, _array_bytes(key_index),
+            _array_bytes(value_index), _array_bytes(hash_table)] +
+            [key + b'\0' for key in keys] +
+            [messages[key] + b'\0' for key in keys])
+
+    def split_entries(self, data):
+        """Split catalog text to entries separated by blank lines.
+
+        Each entry ends with a newline. Comments separated from their
+        entry by blank line end up as separate entries; that's fine for
+        merge_text."""
+        entries = []
+        lines = []
+        for line in data.splitlines(True):
+            if line.strip():
+                lines.append(line)
+            elif lines:
+                entries.append(b''.join(lines))
+                lines = []
+        if lines:
+            entries.append(b''.join(lines))
+        if entries and not entries[-1].endswith(b'\n'):
+            entries[-1] += b'\n'
+        return entries
+
+    def _entry_rank(self, entry):
+        # 1 for normal and 2 for obsolete entries; header is 0, but
+        # merge_text recognizes it by position
+        lines = entry.splitlines()
+        if (all(l.startswith(b'#') for l in lines) and
+                any(l.startswith(b'#~') for l in lines)):
+            return 2
+        return 1
+
+    def _unit_rank(self, unit):
+        if unit.isheader():
+            return 0
+        if unit.isobsolete():
+            return 2
+        return 1
+
+    def _parse_text(self, text, name):
+        return self.load_storage(_named_stream(text, name))
+
+    def _text_hunks(self, base, other):
+        matcher = difflib.SequenceMatcher(None, base, other, autojunk=False)
+        return [(i1, i2, j1, j2)
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+                if tag != 'equal']
+
+    def merge_text(self, base, local, remote):
+        """3-way merge catalogs, parsing only the entries that changed.
+
+        The arguments are (data, name) pairs of the catalog texts. The
+        entries of base are diffed with the entries of local and remote as
+        plain text and only the changed regions are parsed and merged with
+        merge; all the other entries are copied verbatim.
+
+        Returns (data, conflicts), or None when the changes move entries or
+        would put them out of order, in which case the full merge has to be
+        done. Entries made obsolete are usually moved, so they need the full
+        merge too, as does pruning of obsolete entries."""
+        if self.max_obsolete is not None or self.obsolete_similarity is not None:
+            # pruning needs to see all the entries
+            return None
+        inputs = [(self.split_entries(data), name)
+                for data, name in (base, local, remote)]
+        if any(b'\r' in data for data, name in (base, local, remote)):
+            return None
+        # Each side's header has to be parsed even when it did not change,
+        # because the charset and the project name are taken from it.
+        headers = []
+        encodings = set()
+        for entries, name in inputs:
+            header = None
+            if entries:
+                store = self._parse_text(entries[0], name)
+                if store.units and store.units[0].isheader():
+                    header = entries[0]
+                encodings.add(self.get_encoding(store))
+            headers.append(header)
+        if len(encodings) > 1 or (any(headers) and not all(headers)):
+            return None
+
+        groups = []
+        for side, other in enumerate(inputs[1:]):
+            for hunk in self._text_hunks(inputs[0][0], other[0]):
+                groups.append((hunk, side))
+        groups.sort()
+        merged = []
+        for (i1, i2, j1, j2), side in groups:
+            # touching hunks are merged together too, because the order of
+            # insertions at the same place can only be decided by the merge
+            if merged and i1 <= merged[-1][1]:
+                group = merged[-1]
+                group[1] = max(group[1], i2)
+            else:
+                group = [i1, i2, [], []]
+                merged.append(group)
+            group[2 + side].append((i1, i2, j1, j2))
+
+        index = self.conflict_index
+        pieces = [] # (text, rank, conflict records)
+        seen = set()
+        conflicts = 0
+        offsets = [0, 0]
+        pos = 0
+        base_entries = inputs[0][0]
+
+        def verbatim(first, last):
+            for i in xrange(first, last):
+                if i == 0 and headers[0] is not None:
+                    pieces.append((base_entries[i], 0, ()))
+                else:
+                    entry = base_entries[i]
+                    pieces.append((entry, self._entry_rank(entry), ()))
+
+        for start, end, local_hunks, remote_hunks in merged:
+            verbatim(pos, start)
+            ranges = [(start, end)]
+            for side, hunks in enumerate((local_hunks, remote_hunks)):
+                first = start + offsets[side]
+                offsets[side] += sum((j2 - j1) - (i2 - i1)
+                        for i1, i2, j1, j2 in hunks)
+                ranges.append((first, end + offsets[side]))
+            with_header = set(first == 0 and last > 0
+                    for first, last in ranges)
+            if len(with_header) > 1:
+                return None
+            with_header = with_header.pop()
+            # The headers are needed for the names in conflict markers, but
+            # must merge cleanly, so base gets the local one.
+            stores = []
+            for (entries, name), header, (first, last) in zip(inputs,
+                    [headers[1]] + headers[1:], ranges):
+                text = entries[first:last]
+                if header and not with_header:
+                    text = [header] + text
+                stores.append(self._parse_text(b'\n'.join(text), name))
+            keys = set()
+            for store in stores:
+                for unit in store.units:
+                    if not unit.isheader():
+                        keys.add(unicode(unit.getid()))
+            if keys & seen:
+                return None
+            seen |= keys
+            first_record = len(index) if index is not None else 0
+            out, c = self.merge(*stores)
+            conflicts += c
+            records = {}
+            for record in (index or ())[first_record:]:
+                records.setdefault(record['id'], []).append(record)
+            encoding = self.get_encoding(out)
+            for unit in out.units:
+                if unit.isheader() and not with_header:
+                    continue
+                try:
+                    text = unit._getoutput().encode(encoding)
+                except UnicodeEncodeError:
+                    return None
+                pieces.append((text, self._unit_rank(unit),
+                        records.get(unit.getid(), ())))
+            pos = end
+        verbatim(pos, len(base_entries))
+
+        chunks = []
+        line = 1
+        rank = 0
+        for text, piece_rank, records in pieces:
+            if piece_rank < rank:
+                return None
+            rank = piece_rank
+            for record in records:
+                record['line'] = line
+            line += text.count(b'\n') + 1
+            chunks.append(text)
+        return b'\n'.join(chunks), conflicts
+
+    def compact_catalog(self, store):
+        catalog = _CompactCatalog(len(self._line_fields) + 1,
+                store.filename, self.get_encoding(store))
+        for unit in store.units:
+            self.compact_append(catalog, unit)
+        return catalog
+
+    def compact_append(self, catalog, unit):
+        pool = self.strings
+        values = [pool.id(tuple(getattr(unit, field)))
+                for field in self._line_fields]
+        state = 0
+        if isinstance(unit.msgstr, dict):
+            state |= _CompactCatalog.PLURAL
+            values.append(pool.id(tuple(tuple(unit.msgstr[i])
+                for i in sorted(unit.msgstr))))
+        else:
+            values.append(pool.id(tuple(unit.msgstr)))
+        if unit.isobsolete():
+            state |= _CompactCatalog.OBSOLETE
+        if unit.isfuzzy():
+            state |= _CompactCatalog.FUZZY
+        if unit.isheader():
+            state |= _CompactCatalog.HEADER
+        # getid returns multistring for plurals, but the key has to compare
+        # the same way when loaded from ParseCache
+        catalog.append(pool.id(unicode(unit.getid())), state, values)
+
+    def compact_translation(self, catalog, index):
+        """Return pool id of translation of entry, None if untranslated."""
+        value = catalog.columns[-1][index]
+        lines = self.strings.get(value)
+        if catalog.state[index] & _CompactCatalog.PLURAL:
+            lines = chain(*lines)
+        if all(line == '""' for line in lines):
+            return None
+        return value
+
+    def expand_unit(self, catalog, index, store=None):
+        """Create unit from entry of compact catalog."""
+        pool = self.strings
+        unit = self.FileClass.UnitClass()
+        values = catalog.values(index)
+        for field, value in zip(self._line_fields, values):
+            setattr(unit, field, list(pool.get(value)))
+        msgstr = pool.get(values[-1])
+        state = catalog.state[index]
+        if state & _CompactCatalog.PLURAL:
+            unit.msgstr = dict((i, list(lines))
+                    for i, lines in enumerate(msgstr))
+        else:
+            unit.msgstr = list(msgstr)
+        unit.obsolete = bool(state & _CompactCatalog.OBSOLETE)
+        unit.infer_state()
+        unit._store = store
+        return unit
+
+    def expand_catalog(self, catalog):
+        """Convert compact catalog to store."""
+        store = self.FileClass()
+        del store.units[:]
+        store.filename = catalog.filename
+        if catalog.encoding:
+            self.set_encoding(store, catalog.encoding)
+        for i in xrange(len(catalog)):
+            store.addunit(self.expand_unit(catalog, i))
+        return store
+
+    def stub_store(self, catalog):
+        """Create store with just the header of catalog.
+
+        Merging units needs to look at store name and header."""
+        store = self.FileClass()
+        del store.units[:]
+        store.filename = catalog.filename
+        for i in xrange(len(catalog)):
+            if catalog.state[i] & _CompactCatalog.HEADER:
+                store.addunit(self.expand_unit(catalog, i))
+                break
+        return store
+
+    def intern_unit(self, unit):
+        for field in self._line_fields:
+            self.strings.intern_list(getattr(unit, field))
+        # msgstr is a dict of lists for plurals
+        if isinstance(unit.msgstr, dict):
+            for lines in unit.msgstr.values():
+                self.strings.intern_list(lines)
+        else:
+            self.strings.intern_list(unit.msgstr)
+
     def empty_unit(self, template):
         unit = type(template)()
-        unit.setsource(template.getsource())
+        unit.source = template.source
         unit.setcontext(template.getcontext())
         return unit
 
@@ -441,7 +1582,7 @@ class _PoFileDiff(DiffUtils):
 
     def _merge_header(self, out, base, local, remote):
         def newer(left, right, attribute):
-            if self._get_time(left.get(attribute)) >= self._get_time(right.get(attribute)):
+            if self._get_time(left.get(attribute, '')) >= self._get_time(right.get(attribute, '')):
                 return True
             else:
                 return False
@@ -449,8 +1590,10 @@ class _PoFileDiff(DiffUtils):
         base_dict = poheader.parseheaderstring(base.target)
         local_dict = poheader.parseheaderstring(local.target)
         remote_dict = poheader.parseheaderstring(remote.target)
-        out.target = ''
+        lines = []
+        notes = []
         c = 0
+        observer = self.observer
 
         allkeys = self.merge_list(base_dict.keys(),
                 local_dict.keys(), remote_dict.keys())
@@ -460,84 +1603,225 @@ class _PoFileDiff(DiffUtils):
             r = remote_dict.get(key, None)
             if b == l:
                 res = r
+                if observer is not None:
+                    observer.header_decision(key, None, 'remote')
             elif b == r or l == r:
                 res = l
+                if observer is not None:
+                    observer.header_decision(key, None, 'local')
             else: # conflict...
                 if key in self._template_headers:
-                    use_local = newer(local_dict, remote_dict, 'POT-Creation-Date')
+                    rule = 'POT-Creation-Date'
                 else:
-                    use_local = newer(local_dict, remote_dict, 'PO-Revision-Date')
+                    rule = 'PO-Revision-Date'
+                use_local = newer(local_dict, remote_dict, rule)
+                if observer is not None:
+                    observer.header_decision(key, rule,
+                            'local' if use_local else 'remote')
                 if use_local:
                     used, other, ofile = local_dict, remote_dict, remote
                 else:
                     used, other, ofile = remote_dict, local_dict, local
 
                 res = used.get(key, None)
-                out.addnote(u'(conflict) %(file)s (%(project)s): %(key)s: %(value)s' % {
+                notes.append(u'(conflict) %(file)s (%(project)s): %(key)s: %(value)s' % {
                     'file': _getname(ofile._store, ('remote' if use_local else 'local')),
                     'project': other.get('Project-Id-Version', u'???'),
                     'key': key,
                     'value': other.get(key, u'<unset>'),
                     })
+                self.record_conflict(out, 'header', key=key,
+                        winner=('local' if use_local else 'remote'))
                 c = 1
             if res is not None:
-                out.target += '%s: %s\n' % (key, res)
+                lines.append('%s: %s\n' % (key, res))
+        # Setting the target and adding notes one by one would take
+        # quadratic time in number of keys.
+        out.target = ''.join(lines)
+        if notes:
+            out.addnote(u'\n'.join(notes))
         out.markfuzzy(
                 self.merge_simple(base.isfuzzy(), local.isfuzzy(),
                         remote.isfuzzy()))
         return c
 
+    def _set_translation_from(self, out, unit):
+        # the previous msgid and fuzzy go with the translation
+        out.target = unit.target
+        if unit.prev_msgid:
+            out.prev_msgctxt = unit.prev_msgctxt
+            out.prev_msgid = unit.prev_msgid
+            out.prev_msgid_plural = unit.prev_msgid_plural
+        out.markfuzzy(unit.isfuzzy())
+
+    def _quality(self, unit):
+        return 0 if unit.isblank() else 1 if unit.isfuzzy() else 2
+
+    def _set_conflict(self, out, units, defaults):
+        """Set target of out to msgcat-style list of translations of units.
+
+        The defaults are names of the sides for stores without filename."""
+        tmpl = u"".join(u"#-#-#-#-#  %s (%s)  #-#-#-#-#\n%%s\n" % (
+                    _getname(unit._store, default),
+                    unit._store.parseheader().get("Project-Id-Version", u"???"))
+                for unit, default in zip(units, defaults))
+        strings = [list(getattr(unit.target, "strings", [unit.target]))
+                for unit in units]
+        count = max(len(ss) for ss in strings)
+        for ss in strings:
+            ss.extend([u""] * (count - len(ss)))
+        if units[0].hasplural():
+            out.target = multistring([tmpl % tuple(ss[i] for ss in strings)
+                for i in range(count)])
+        else:
+            out.target = tmpl % tuple(ss[0] for ss in strings)
+        out.markfuzzy()
+
     def _merge_target(self, out, base, local, remote):
         # Comments were easy. Now we have to decide from which side we want
         # the translation from and the other things like previous msgid and
         # fuzzy go with it.
         def set_translation_from(unit):
-            out.target = unit.target
-            if unit.prev_msgid:
-                out.prev_msgctxt = unit.prev_msgctxt
-                out.prev_msgid = unit.prev_msgid
-                out.prev_msgid_plural = unit.prev_msgid_plural
-            out.markfuzzy(unit.isfuzzy())
+            self._set_translation_from(out, unit)
 
+        observer = self.observer
         # First this is 3-way merge, so change trumphs no change.
         if self._equal_translation(base, local):
             set_translation_from(remote)
+            decision = 'remote'
         elif self._equal_translation(base, remote):
             set_translation_from(local)
+            decision = 'local'
         # Same change on both sides is trivial.
         elif self._equal_translation(local, remote):
             set_translation_from(local)
+            decision = 'same'
         # Now starts conflict resolution.
         else:
-            lqual = 0 if local.isblank() else 1 if local.isfuzzy() else 2
-            rqual = 0 if remote.isblank() else 1 if remote.isfuzzy() else 2
+            lqual = self._quality(local)
+            rqual = self._quality(remote)
             if lqual > rqual:
                 set_translation_from(local)
+                decision = 'local-quality'
             elif rqual > lqual:
                 set_translation_from(remote)
+                decision = 'remote-quality'
             else:
-                ls = getattr(local.target, "strings", [local.target])
-                rs = getattr(remote.target, "strings", [remote.target])
-                tmpl = (u"#-#-#-#-#  %s (%s)  #-#-#-#-#\n" +
-                        u"%%s\n" +
-                        u"#-#-#-#-#  %s (%s)  #-#-#-#-#\n" +
-                        u"%%s\n") % (
-                                _getname(local._store, 'local'),
-                                local._store.parseheader().get("Project-Id-Version", u"???"),
-                                _getname(remote._store, 'remote'),
-                                remote._store.parseheader().get("Project-Id-Version", u"???"))
-                while len(ls) < len(rs):
-                    ls.append(u"")
-                while len(rs) < len(ls):
-                    rs.append(u"")
-                if local.hasplural():
-                    out.target = multistring([tmpl % (l, r) for l, r in zip(ls, rs)])
-                else:
-                    out.target = tmpl % (ls[0], rs[0])
-                out.markfuzzy()
+                self._set_conflict(out, (local, remote), ('local', 'remote'))
+                self.record_conflict(out, 'translation', winner=None)
+                if observer is not None:
+                    observer.target_decision(out, 'conflict')
                 return 1 # conflict
+        if observer is not None:
+            observer.target_decision(out, decision)
         return 0
 
+    def _merge_unit_many(self, base, sides, names):
+        out = self.empty_unit(sides[0])
+        for l in self.merge_list_many(base.getlocations(),
+                [u.getlocations() for u in sides]):
+            out.addlocation(l)
+        for origin in ('developer', 'translator'):
+            for n in self.merge_list_many(
+                    base.getnotes(origin=origin).split('\n'),
+                    [u.getnotes(origin=origin).split('\n') for u in sides]):
+                out.addnote(n, origin=origin)
+        self._set_types(out, self.merge_list_many(self._get_types(base),
+                [self._get_types(u) for u in sides]))
+        if self.merge_simple_many(base.isobsolete(),
+                [u.isobsolete() for u in sides]):
+            out.makeobsolete()
+
+        if sides[0].isheader():
+            c = self._merge_header_many(out, base, sides, names)
+        else:
+            c = self._merge_target_many(out, base, sides, names)
+        return out, c
+
+    def _merge_header_many(self, out, base, sides, names):
+        base_dict = poheader.parseheaderstring(base.target)
+        dicts = [poheader.parseheaderstring(u.target) for u in sides]
+        lines = []
+        notes = []
+        c = 0
+        observer = self.observer
+
+        allkeys = self.merge_list_many(base_dict.keys(),
+                [d.keys() for d in dicts])
+        for key in allkeys:
+            b = base_dict.get(key, None)
+            changed = [k for k, d in enumerate(dicts) if d.get(key, None) != b]
+            values = set(dicts[k].get(key, None) for k in changed)
+            rule = None
+            if not changed:
+                res, winner = b, 0
+            elif len(values) == 1:
+                res, winner = values.pop(), changed[0]
+            else: # conflict; the newest of the changed sides wins
+                if key in self._template_headers:
+                    rule = 'POT-Creation-Date'
+                else:
+                    rule = 'PO-Revision-Date'
+                winner = changed[0]
+                for k in changed[1:]:
+                    if (self._get_time(dicts[k].get(rule, '')) >
+                            self._get_time(dicts[winner].get(rule, ''))):
+                        winner = k
+                res = dicts[winner].get(key, None)
+                for k in changed:
+                    if dicts[k].get(key, None) != res:
+                        notes.append(u'(conflict) %(file)s (%(project)s): %(key)s: %(value)s' % {
+                            'file': names[k],
+                            'project': dicts[k].get('Project-Id-Version', u'???'),
+                            'key': key,
+                            'value': dicts[k].get(key, u'<unset>'),
+                            })
+                self.record_conflict(out, 'header', key=key,
+                        winner=names[winner])
+                c = 1
+            if observer is not None:
+                observer.header_decision(key, rule, names[winner])
+            if res is not None:
+                lines.append('%s: %s\n' % (key, res))
+        out.target = ''.join(lines)
+        if notes:
+            out.addnote(u'\n'.join(notes))
+        out.markfuzzy(self.merge_simple_many(base.isfuzzy(),
+                [u.isfuzzy() for u in sides]))
+        return c
+
+    def _merge_target_many(self, out, base, sides, names):
+        # Like _merge_target: change trumphs no change, translated trumphs
+        # fuzzy trumphs untranslated and anything else is a conflict.
+        changed = [k for k, u in enumerate(sides)
+                if not self._equal_translation(base, u)]
+        candidates = []
+        for k in changed:
+            if not any(self._equal_translation(sides[k], sides[o])
+                    for o in candidates):
+                candidates.append(k)
+        if not candidates:
+            self._set_translation_from(out, sides[-1])
+            decision = 'unchanged'
+        elif len(candidates) == 1:
+            self._set_translation_from(out, sides[candidates[0]])
+            decision = 'changed' if len(changed) == 1 else 'same'
+        else:
+            best = max(self._quality(sides[k]) for k in candidates)
+            candidates = [k for k in candidates
+                    if self._quality(sides[k]) == best]
+            if len(candidates) == 1:
+                self._set_translation_from(out, sides[candidates[0]])
+                decision = 'quality'
+            else:
+                self._set_conflict(out, [sides[k] for k in candidates],
+                        [names[k] for k in candidates])
+                self.record_conflict(out, 'translation', winner=None)
+                decision = 'conflict'
+        if self.observer is not None:
+            self.observer.target_decision(out, decision)
+        return 1 if decision == 'conflict' else 0
+
 _differs = {
         'pofile': _PoFileDiff
         }
@@ -553,15 +1837,649 @@ def get_differ(_class):
         raise ValueError("DiffUtils is not implemented for %s"
                 % (_class.Name))
 
+def _lzma():
+    if lzma is None:
+        raise ValueError('xz compressed catalogs need the lzma module '
+                '(backports.lzma for Python 2)')
+    return lzma
+
+def _decompress(data):
+    """Decompress gzip, bzip2 or xz compressed data, recognized by magic.
+
+    Other data are returned as they are."""
+    if data.startswith(b'\x1f\x8b'):
+        return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    if data.startswith(b'BZh'):
+        return bz2.decompress(data)
+    if data.startswith(b'\xfd7zXZ\x00'):
+        return _lzma().decompress(data)
+    return data
+
+def _compress(path, data):
+    """Compress data according to extension (.gz, .bz2 or .xz) of path."""
+    if path.endswith('.gz'):
+        # without the time the output does not change when the data don't
+        buf = io.BytesIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+        f.write(data)
+        f.close()
+        return buf.getvalue()
+    if path.endswith('.bz2'):
+        return bz2.compress(data)
+    if path.endswith('.xz'):
+        return _lzma().compress(data)
+    return data
+
+def _read_catalog(source):
+    """Return (data, name) of catalog given as file name or file object.
+
+    Compressed catalogs are decompressed in memory."""
+    if hasattr(source, 'read'):
+        data, name = source.read(), getattr(source, 'name', '')
+    else:
+        with open(source, 'rb') as f:
+            data, name = f.read(), source
+    return _decompress(data), name
+
+def _write_file(path, data):
+    """Write data to file unless it already has exactly that content.
+
+    Leaving unchanged file alone keeps its mtime, so make and git don't
+    consider it modified. Otherwise the data are written to temporary file
+    that is then renamed over the target, so the target is never left
+    truncated. Returns whether the file was written."""
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = None
+    # Not mkstemp, because that creates the file private; new files should
+    # get the default permissions, with the umask applied by the kernel.
+    directory, name = os.path.split(path)
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    while True:
+        tmp = os.path.join(directory, '.%s.%08x.tmp' % (name,
+            random.getrandbits(32)))
+        try:
+            fd = os.open(tmp, flags, 0o666)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            if os.name != 'nt':
+                raise
+            # Windows can't rename over existing file
+            os.remove(path)
+            os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+    return True
+
+class ParseCache(object):
+    """Directory with compact catalogs stored by content of the files.
+
+    Loading catalog from the cache is several times faster than parsing
+    it. The cache entries are keyed by hash of the file content and versions
+    of this tool, Translate Toolkit and Python, since each of them might
+    change what is stored. When total size of the entries exceeds max_size
+    bytes, the least recently used are removed."""
+
+    # increment when changing what or how is stored
+    _format = 1
+
+    def __init__(self, directory, max_size=256 << 20):
+        self.directory = directory
+        self.max_size = max_size
+        self._version = '%d %s %d.%d' % (self._format, toolkit_version.sver,
+                sys.version_info[0], sys.version_info[1])
+
+    def _path(self, data):
+        digest = hashlib.sha1(self._version.encode('ascii'))
+        digest.update(data)
+        return os.path.join(self.directory, digest.hexdigest() + '.cache')
+
+    def get(self, data):
+        """Return (_StringPool, _CompactCatalog) for data or None.
+
+        Other processes using the cache may remove the entry at any time,
+        which is the same as if it was evicted."""
+        path = self._path(data)
+        try:
+            with open(path, 'rb') as f:
+                stored = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            version, values, key, state, columns, encoding = \
+                    marshal.loads(stored)
+            if version != self._version:
+                raise ValueError('Cache entry version mismatch')
+            strings = _StringPool()
+            strings.__setstate__(list(values))
+            catalog = _CompactCatalog(0, None, encoding)
+            catalog.key = array('i', key)
+            catalog.state = array('B', state)
+            catalog.columns = tuple(array('i', c) for c in columns)
+            if not all(len(c) == len(catalog.key)
+                    for c in (catalog.state,) + catalog.columns):
+                raise ValueError('Cache entry is damaged')
+            if any(c and max(c) >= len(values)
+                    for c in (catalog.key,) + catalog.columns):
+                raise ValueError('Cache entry is damaged')
+        except (ValueError, EOFError, TypeError):
+            # anything wrong with the entry means we parse the file again
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path, None) # mark recently used
+        except OSError:
+            pass
+        return strings, catalog
+
+    def put(self, data, strings, catalog):
+        """Store catalog with its string pool strings for data."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # store only the values the catalog uses
+        own = _StringPool()
+        catalog = catalog.copy()
+        catalog.repool(strings, own)
+        _write_file(self._path(data), marshal.dumps((self._version,
+            own._values, _array_bytes(catalog.key),
+            _array_bytes(catalog.state),
+            [_array_bytes(c) for c in catalog.columns], catalog.encoding)))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue # evicted by another process
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+        entries.sort()
+        while total > self.max_size and entries:
+            mtime, size, name = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass # evicted by another process
+            total -= size
+
+class MergeSession(object):
+    """Merges translation catalogs in process.
+
+    The session is meant for services that merge many catalogs. It caches
+    parsed catalogs by content hash, so merging the same base or local
+    catalog again does not parse it again. Cached catalogs are never
+    modified by merging.
+
+    Catalogs can be given as file names, bytearrays or file-like objects
+    and may be compressed with gzip, bzip2 or xz. In Python 3, bytes and
+    memoryview are content too.
+    The cache is limited by total size of the cached catalog files in bytes;
+    least recently used catalogs are dropped when it is exceeded. Other
+    keyword arguments are options of the differ (see DiffUtils).
+    """
+
+    # number of batches of merged units the queue to the writer thread of
+    # pipelined merge holds, and number of units in a batch
+    pipeline_queue_size = 8
+    pipeline_batch_size = 256
+
+    # number of strings the string pool may grow by over twice its size
+    # after it was last rebuilt before it is rebuilt again
+    pool_slack = 1 << 12
+
+    def __init__(self, cache_size=64 << 20, compact=False,
+            FileClass=pypo.pofile, jobs=1, parse_cache=None, prefilter=False,
+            pipeline=False, **options):
+        self.cache_size = cache_size
+        self.compact = compact
+        self.prefilter = prefilter
+        self.pipeline = pipeline
+        self.FileClass = FileClass
+        self.jobs = jobs
+        self.parse_cache = parse_cache
+        self.differ = get_differ(FileClass)(**options)
+        self._cache = OrderedDict()
+        self._cached_size = 0
+        self._pool_size = 0
+
+    def _read(self, source):
+        if isinstance(source, _buffer_types):
+            return _decompress(bytes(source)), ''
+        return _read_catalog(source)
+
+    def _parse(self, data, name):
+        stream = _named_stream(data, name)
+        if self.compact:
+            return self.differ.load_compact(stream)
+        return self.differ.load_storage(stream)
+
+    def _parse_parallel(self, inputs):
+        # The workers return compact catalogs with their own string pools,
+        # which are much cheaper to transfer than units.
+        pool = multiprocessing.Pool(min(self.jobs, len(inputs)))
+        try:
+            results = pool.map(_parse_compact,
+                    [(self.FileClass, data, name) for data, name in inputs])
+        finally:
+            pool.close()
+            pool.join()
+        stores = []
+        for strings, catalog in results:
+            catalog.repool(strings, self.differ.strings)
+            if not self.compact:
+                catalog = self.differ.expand_catalog(catalog)
+            stores.append(catalog)
+        return stores
+
+    def _from_parse_cache(self, data, name):
+        cached = self.parse_cache.get(data)
+        if cached is None:
+            return None
+        strings, catalog = cached
+        catalog.filename = name
+        catalog.repool(strings, self.differ.strings)
+        if not self.compact:
+            catalog = self.differ.expand_catalog(catalog)
+        return catalog
+
+    def load(self, source):
+        """Return parsed catalog, from the cache if possible.
+
+        The result is store or _CompactCatalog depending on compact option
+        of the session and must not be modified."""
+        return self.load_many([source])[0]
+
+    def load_many(self, sources):
+        """Return list of parsed catalogs like load.
+
+        If the session has more than one job, catalogs that are not cached
+        are parsed in parallel processes."""
+        inputs = [self._read(source) for source in sources]
+        keys = [(hashlib.sha1(data).hexdigest(), name)
+                for data, name in inputs]
+        stores = {}
+        todo = []
+        for key, (data, name) in zip(keys, inputs):
+            if key in stores:
+                continue
+            if key in self._cache:
+                store, size = self._cache.pop(key)
+                self._cache[key] = (store, size) # mark most recently used
+                stores[key] = store
+            else:
+                stores[key] = None
+                todo.append((key, data, name))
+        if self.parse_cache is not None:
+            parsed = [self._from_parse_cache(d, n) for k, d, n in todo]
+            for (key, data, name), store in zip(todo, parsed):
+                stores[key] = store
+            missing = [t for t, store in zip(todo, parsed) if store is None]
+        else:
+            missing = todo
+        if self.jobs > 1 and len(missing) > 1:
+            parsed = self._parse_parallel([(d, n) for k, d, n in missing])
+        else:
+            parsed = [self._parse(d, n) for k, d, n in missing]
+        for (key, data, name), store in zip(missing, parsed):
+            stores[key] = store
+            if self.parse_cache is not None:
+                if self.compact:
+                    catalog = store
+                else:
+                    catalog = self.differ.compact_catalog(store)
+                self.parse_cache.put(data, self.differ.strings, catalog)
+        for key, data, name in todo:
+            store = stores[key]
+            if len(data) <= self.cache_size:
+                self._cache[key] = (store, len(data))
+                self._cached_size += len(data)
+        result = [stores[key] for key in keys]
+        self._evict(result)
+        return result
+
+    def _evict(self, keep=()):
+        """Drop least recently used catalogs until the cache fits its size.
+
+        The string pool also keeps the strings of catalogs that were not
+        cached and of merge results alive, so it is rebuilt with just the
+        cached catalogs when it grows too much since the last rebuild.
+        Catalogs in keep are in use by the caller, so in compact mode they
+        are moved to the new string pool along with the cached ones."""
+        if (self._cached_size <= self.cache_size and
+                len(self.differ.strings) <=
+                2 * self._pool_size + self.pool_slack):
+            return
+        while self._cached_size > self.cache_size:
+            store, size = self._cache.popitem(last=False)[1]
+            self._cached_size -= size
+        # The string pool would keep the strings of dropped catalogs alive,
+        # so start a new one with just the remaining catalogs.
+        old, self.differ.strings = self.differ.strings, _StringPool()
+        cached = [store for store, size in self._cache.values()]
+        for store in cached:
+            if self.compact:
+                store.repool(old, self.differ.strings)
+            else:
+                self.differ.intern_store(store)
+        self._pool_size = len(self.differ.strings)
+        if self.compact:
+            moved = set(id(store) for store in cached)
+            for store in keep:
+                if id(store) not in moved:
+                    moved.add(id(store))
+                    store.repool(old, self.differ.strings)
+
+    def cache_store(self, data, name, store):
+        """Put store of catalog with given data and file name to the cache.
+
+        This lets caller that wrote merged catalog merge it again without
+        parsing it. The store gets the name as filename and must not be
+        modified afterwards."""
+        key = (hashlib.sha1(data).hexdigest(), name)
+        if key in self._cache or len(data) > self.cache_size:
+            return
+        store.filename = name
+        if self.compact:
+            store = self.differ.compact_catalog(store)
+        self._cache[key] = (store, len(data))
+        self._cached_size += len(data)
+        self._evict()
+
+    def clear(self):
+        """Drop all cached catalogs."""
+        self._cache.clear()
+        self._cached_size = 0
+        self.differ.strings = _StringPool()
+        self._pool_size = 0
+
+    def merge(self, base, local, remote, conflict_index=None):
+        """3-way merge catalogs.
+
+        Returns merged store and number of conflicts like DiffUtils.merge.
+        If conflict_index list is given, records of the conflicts are
+        appended to it; serialize the result with serialize to get their
+        lines. The base may also be a list of several merge bases, which
+        are merged to a virtual base first (see DiffUtils.merge_bases); each
+        catalog is still only parsed once."""
+        bases = list(base) if isinstance(base, (list, tuple)) else [base]
+        catalogs = self.load_many(bases + [local, remote])
+        bases, local, remote = catalogs[:-2], catalogs[-2], catalogs[-1]
+        base = self.differ.merge_bases(bases, self.compact)
+        self.differ.conflict_index = conflict_index
+        try:
+            if self.compact:
+                out, conflicts = self.differ.merge_compact(base=base,
+                        local=local, remote=remote)
+                out = self.differ.expand_catalog(out)
+            else:
+                out, conflicts = self.differ.merge(base=base, local=local,
+                        remote=remote)
+        finally:
+            self.differ.conflict_index = None
+        self._evict()
+        return out, conflicts
+
+    def serialize(self, store, conflict_index=None, rendered=None):
+        """Convert merged store to string, filling lines in conflict_index."""
+        return self.differ.serialize(store, conflict_index, rendered)
+
+    def merge_to_string(self, base, local, remote, conflict_index=None):
+        """3-way merge catalogs and return (data, conflicts).
+
+        With the prefilter option of the session, the catalogs are first
+        diffed as text and only the changed entries are parsed and merged,
+        unless the changes move entries (see _PoFileDiff.merge_text). The
+        catalogs are not cached in that case.
+
+        With the pipeline option, reading, merging and serialization run in
+        separate threads (see _merge_pipelined). The result is the same.
+        The pipeline is not used with the compact option of the session.
+        Neither option is used when several bases are given."""
+        if isinstance(base, (list, tuple)):
+            if len(base) > 1:
+                out, conflicts = self.merge(base, local, remote,
+                        conflict_index)
+                return self.serialize(out, conflict_index), conflicts
+            base, = base
+        if self.prefilter:
+            inputs = [self._read(source) for source in (base, local, remote)]
+            self.differ.conflict_index = conflict_index
+            try:
+                result = self.differ.merge_text(*inputs)
+            finally:
+                self.differ.conflict_index = None
+            self._evict()
+            if result is not None:
+                return result
+            if conflict_index is not None:
+                del conflict_index[:]
+            base, local, remote = [_named_stream(data, name)
+                    for data, name in inputs]
+        if self.pipeline and not self.compact:
+            return self._merge_pipelined((base, local, remote),
+                    conflict_index)
+        out, conflicts = self.merge(base, local, remote, conflict_index)
+        return self.serialize(out, conflict_index), conflicts
+
+    def _merge_pipelined(self, sources, conflict_index):
+        """Merge sources with reading, merging and serialization overlapped.
+
+        A reader thread reads the files while the previous ones are parsed,
+        and a writer thread renders the merged units while the merge goes
+        on. The stages are connected by bounded queues, so a fast stage can
+        not get far ahead of a slow one. The units are passed in batches to
+        keep the locking overhead low. Parsing and merging stay in this
+        thread, because they share the string pool. The catalogs are not
+        cached."""
+        inputs = queue.Queue(len(sources))
+        units = queue.Queue(self.pipeline_queue_size)
+        rendered = ([], [], [])
+        errors = []
+
+        def read():
+            for source in sources:
+                try:
+                    inputs.put((self._read(source), None))
+                except Exception as e:
+                    inputs.put((None, e))
+                    return
+
+        def render():
+            while True:
+                item = units.get()
+                if item is None:
+                    return
+                if errors:
+                    continue # keep draining so that the merge does not block
+                try:
+                    for rank, unit in item:
+                        rendered[rank].append(self.differ.render_unit(unit))
+                except Exception as e:
+                    errors.append(e)
+
+        batch = []
+        def sink(rank, unit):
+            batch.append((rank, unit))
+            if len(batch) >= self.pipeline_batch_size:
+                units.put(batch[:])
+                del batch[:]
+
+        reader = threading.Thread(target=read)
+        writer = threading.Thread(target=render)
+        reader.daemon = writer.daemon = True
+        reader.start()
+        writer.start()
+        try:
+            stores = []
+            for source in sources:
+                data, error = inputs.get()
+                if error is not None:
+                    raise error
+                stores.append(self._parse(*data))
+            self.differ.conflict_index = conflict_index
+            try:
+                out, conflicts = self.differ.merge(*stores, sink=sink)
+            finally:
+                self.differ.conflict_index = None
+            units.put(batch)
+        finally:
+            units.put(None)
+            writer.join()
+        self._evict()
+        if errors:
+            raise errors[0]
+        return self.serialize(out, conflict_index,
+                list(chain(*rendered))), conflicts
+
+class MergeWatcher(object):
+    """Keeps local catalogs merged with their base and remote catalogs.
+
+    The triples are (base, local, remote) file names. Each poll checks
+    which files changed and merges the triples they belong to, writing the
+    result over local. Files are only read when their mtime or size
+    changed and only count as changed when their content hash did too.
+    When a merge changes a local that other triples use as base or remote,
+    those triples are merged too, in the same poll unless they were already
+    merged in it. The parsed catalogs stay in the cache of the MergeSession,
+    including the merged result, so a merge only parses the files that
+    changed."""
+
+    def __init__(self, triples, session=None):
+        self.triples = [tuple(t) for t in triples]
+        self.session = session or MergeSession()
+        # file name -> (mtime, size, sha1 of content)
+        self._state = {}
+        # triples to merge because a local they use was written
+        self._pending = set()
+
+    def _check(self, path):
+        """Return content of path if it changed since last check, else None.
+
+        Missing file does not count as changed."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._state.pop(path, None)
+            return None
+        old = self._state.get(path)
+        if old is not None and old[:2] == (st.st_mtime, st.st_size):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        self._state[path] = (st.st_mtime, st.st_size, digest)
+        if old is not None and old[2] == digest:
+            return None
+        return data
+
+    def _remember(self, path, data):
+        st = os.stat(path)
+        self._state[path] = (st.st_mtime, st.st_size,
+                hashlib.sha1(data).hexdigest())
+
+    def poll(self):
+        """Merge the triples with changed files.
+
+        All triples are merged on the first poll. Returns list of (local,
+        conflicts, error) for the merged triples; error is the exception if
+        the merge failed, in which case it is tried again when any of the
+        files changes again."""
+        changed = {}
+        for path in set(chain(*self.triples)):
+            data = self._check(path)
+            if data is not None:
+                changed[path] = data
+        self._pending.update(triple for triple in self.triples
+                if any(path in changed for path in triple))
+        results = []
+        merged = set()
+        while True:
+            todo = [triple for triple in self.triples
+                    if triple in self._pending and triple not in merged]
+            if not todo:
+                return results
+            for triple in todo:
+                merged.add(triple)
+                self._pending.discard(triple)
+                if not all(path in self._state for path in triple):
+                    continue # some file is missing
+                base, local, remote = [
+                        _named_stream(changed[path], path) if path in changed
+                        else path for path in triple]
+                try:
+                    out, conflicts = self.session.merge(base, local, remote)
+                    data = self.session.serialize(out)
+                    written = _compress(triple[1], data)
+                    wrote = _write_file(triple[1], written)
+                except Exception as e:
+                    results.append((triple[1], None, e))
+                    continue
+                self._remember(triple[1], written)
+                self.session.cache_store(data, triple[1], out)
+                results.append((triple[1], conflicts, None))
+                if wrote:
+                    changed[triple[1]] = written
+                    self._pending.update(other for other in self.triples
+                            if other != triple and triple[1] in other)
+
+def _named_stream(data, name):
+    stream = io.BytesIO(data)
+    stream.name = name
+    return stream
+
+def _parse_compact(args):
+    """Parse catalog to compact form in worker process of MergeSession."""
+    FileClass, data, name = args
+    differ = get_differ(FileClass)()
+    return differ.strings, differ.load_compact(_named_stream(data, name))
+
 #########################################################################
 # The user-level commadns, to be split in individual commands in
 # translate.tools
-from argparse import ArgumentParser, FileType
-import sys
+from argparse import ArgumentParser, ArgumentTypeError, FileType
+import json
 
 # FIXME: temporary - the load_storage is messed up
 from translate.storage.pypo import pofile
 
+def _write_output(path, data):
+    """Write data to file, or standard output if path is None.
+
+    The data are compressed if the file name ends with .gz, .bz2 or .xz."""
+    if path:
+        _write_file(path, _compress(path, data))
+    else:
+        # the data are bytes, which Python 3 only writes to the buffer
+        getattr(sys.stdout, 'buffer', sys.stdout).write(data)
+
+def _parse_cache(args):
+    if args.cache_dir:
+        return ParseCache(args.cache_dir, args.cache_dir_size << 20)
+    return None
+
 def merge(args):
     """3-way merge translation catalogs.
 
@@ -573,17 +2491,154 @@ def merge(args):
         args.out = args.local
 
     # FIXME: Use the auto-detection at least a bit
-    differ = get_differ(pofile)() # FIXME: pass options
-    base = differ.load_storage(args.base)
-    local = differ.load_storage(args.local)
-    remote = differ.load_storage(args.remote)
+    session = MergeSession(cache_size=0, compact=args.compact,
+            FileClass=pofile, jobs=args.jobs,
+            parse_cache=_parse_cache(args), prefilter=args.prefilter,
+            pipeline=args.pipeline,
+            max_obsolete=0 if args.no_obsolete else args.max_obsolete,
+            obsolete_similarity=args.obsolete_similarity)
+    index = [] if args.conflict_index else None
+    base = [args.base] + args.extra_bases
+    if args.mo_out:
+        # the prefilter does not give the merged store
+        out, conflicts = session.merge(base, args.local, args.remote,
+                conflict_index=index)
+        data = session.serialize(out, index)
+        _write_file(args.mo_out, session.differ.compile_mo(out))
+    else:
+        data, conflicts = session.merge_to_string(base, args.local,
+                args.remote, conflict_index=index)
+
+    _write_output(args.out, data)
+    if index is not None:
+        for record in index:
+            del record['id']
+        _write_file(args.conflict_index, ''.join(
+            json.dumps(record, sort_keys=True) + '\n'
+            for record in index).encode('ascii'))
+    if conflicts and not args.succeed:
+        sys.exit(1)
 
-    out, conflicts = differ.merge(base=base, local=local, remote=remote)
+def merge_many(args):
+    """N-way merge of translation catalogs with common base.
 
-    out.savefile(file(args.out, 'w') if args.out else sys.stdout)
+    Merges any number of catalogs at once, like repeated 3-way merge of
+    each of them to the first one, but each input is only parsed once.
+    Conflict markers list all the catalogs that changed the translation.
+    """
+    if args.update:
+        args.out = args.catalogs[0]
+    differ = get_differ(pofile)(
+            max_obsolete=0 if args.no_obsolete else args.max_obsolete,
+            obsolete_similarity=args.obsolete_similarity)
+    out, conflicts = differ.merge_many(differ.load_storage(args.base),
+            [differ.load_storage(catalog) for catalog in args.catalogs])
+    _write_output(args.out, differ.serialize(out))
+    if args.mo_out:
+        _write_file(args.mo_out, differ.compile_mo(out))
     if conflicts and not args.succeed:
         sys.exit(1)
 
+def stat_catalogs(args):
+    """Summarize changes between two versions of translation catalog.
+
+    Prints numbers of entries added, removed (including made obsolete),
+    with changed translation, newly fuzzy and newly translated.
+    """
+    session = MergeSession(cache_size=0, compact=True, FileClass=pofile,
+            jobs=args.jobs, parse_cache=_parse_cache(args))
+    old, new = session.load_many((args.old, args.new))
+    counts = session.differ.stat(old, new)
+    if args.json:
+        print(json.dumps(counts, sort_keys=True))
+    else:
+        print('%(added)d added, %(removed)d removed, %(changed)d changed, '
+                '%(fuzzied)d fuzzied, %(translated)d translated' % counts)
+
+def update(args):
+    """Update translation catalogs from template.
+
+    Like msgmerge, entries are matched by their id/context+source, locations,
+    extracted comments and flags are taken from the template, translations
+    are kept and entries no longer in the template are made obsolete. Any
+    number of catalogs can be updated against the same template, which is
+    only parsed once.
+    """
+    if len(args.catalogs) > 1 and not args.update:
+        sys.exit('More than one catalog can only be updated with -U')
+
+    # The strings of the catalogs are mostly different, so don't intern
+    differ = get_differ(pofile)(intern=False)
+    template = differ.load_storage(args.template)
+    for catalog in args.catalogs:
+        store = differ.update(differ.load_storage(catalog), template)
+        _write_output(catalog if args.update else args.out,
+                differ.serialize(store))
+
+def watch(args):
+    """Keep translation catalogs merged as they change.
+
+    Watches triples of base, local and remote catalogs and whenever any of
+    them changes, 3-way merges them and writes the result over local.
+    Changes are found by polling. The parsed catalogs are kept in memory,
+    so only the changed files are parsed again.
+    """
+    if len(args.files) % 3:
+        sys.exit('The files have to be given as base, local, remote triples')
+    session = MergeSession(cache_size=args.cache_size << 20,
+            compact=args.compact, FileClass=pofile,
+            max_obsolete=0 if args.no_obsolete else args.max_obsolete,
+            obsolete_similarity=args.obsolete_similarity)
+    watcher = MergeWatcher(zip(*[iter(args.files)] * 3), session)
+    try:
+        while True:
+            for local, conflicts, error in watcher.poll():
+                if error is not None:
+                    sys.stderr.write('%s: %s\n' % (local, error))
+                else:
+                    print('%s: merged with %d conflicts' % (local, conflicts))
+            sys.stdout.flush()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+def _add_cache_arguments(parser):
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+            default=1,
+            help='number of processes to load the inputs with (default 1)')
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar='DIR',
+            help='keep parsed catalogs in DIR to load them faster next time')
+    parser.add_argument('--cache-dir-size', dest='cache_dir_size',
+            metavar='MB', type=int, default=256,
+            help='maximum size of the cache directory in MiB (default 256)')
+
+def _non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise ArgumentTypeError('must not be negative: %s' % value)
+    return number
+
+def _ratio(value):
+    number = float(value)
+    if not 0 <= number <= 1:
+        raise ArgumentTypeError('must be between 0 and 1: %s' % value)
+    return number
+
+def _add_obsolete_arguments(parser):
+    parser.add_argument('--no-obsolete', dest='no_obsolete',
+            action='store_true', help='drop all obsolete entries')
+    parser.add_argument('--max-obsolete', dest='max_obsolete',
+            metavar='N', type=_non_negative_int,
+            help='keep at most N obsolete entries')
+    parser.add_argument('--obsolete-similarity',
+            dest='obsolete_similarity', metavar='RATIO', type=_ratio,
+            help='only keep obsolete entries whose msgid resembles msgid of '
+            'a current entry with similarity at least RATIO (0 to 1)')
+
+def _add_mo_argument(parser):
+    parser.add_argument('--mo-out', dest='mo_out', metavar='FILE',
+            help='also compile the result to MO file FILE like msgfmt')
+
 def main():
     parser = ArgumentParser(description=__doc__)
 
@@ -593,6 +2648,28 @@ def main():
     mergeparser.add_argument('-n', '--no-error', dest='succeed',
             action='store_true',
             help='exit with 0 status even if there are conflicts')
+    mergeparser.add_argument('-c', '--compact', dest='compact',
+            action='store_true',
+            help='keep the catalogs in compact form to save memory; '
+            'entries that are the same on both sides are copied verbatim')
+    _add_cache_arguments(mergeparser)
+    mergeparser.add_argument('--prefilter', dest='prefilter',
+            action='store_true',
+            help='diff the files as text first and only merge the entries '
+            'that changed; the rest is copied verbatim')
+    mergeparser.add_argument('--pipeline', dest='pipeline',
+            action='store_true',
+            help='read, merge and write the files in separate threads; '
+            'not used with -c, --mo-out or --extra-base')
+    _add_obsolete_arguments(mergeparser)
+    _add_mo_argument(mergeparser)
+    mergeparser.add_argument('--extra-base', dest='extra_bases',
+            action='append', default=[], metavar='FILE',
+            help='another merge base for criss-cross merges; the bases are '
+            'merged to a virtual base first; can be repeated')
+    mergeparser.add_argument('--conflict-index', dest='conflict_index',
+            metavar='FILE',
+            help='write list of conflicts as JSON lines to FILE')
     outgrp = mergeparser.add_mutually_exclusive_group()
     outgrp.add_argument('-o', '--out', '--output', dest='out',
             help='output file (defaults to standard output)')
@@ -604,6 +2681,58 @@ def main():
     mergeparser.add_argument('remote',
             help='the file to be merged from')
 
+    manyparser = subparsers.add_parser('merge-many',
+            description=merge_many.__doc__)
+    manyparser.set_defaults(function=merge_many)
+    manyparser.add_argument('-n', '--no-error', dest='succeed',
+            action='store_true',
+            help='exit with 0 status even if there are conflicts')
+    _add_obsolete_arguments(manyparser)
+    _add_mo_argument(manyparser)
+    outgrp = manyparser.add_mutually_exclusive_group()
+    outgrp.add_argument('-o', '--out', '--output', dest='out',
+            help='output file (defaults to standard output)')
+    outgrp.add_argument('-U', '--update', dest='update',
+            action='store_true', help='write output over the first catalog')
+    manyparser.add_argument('base', help='common base of the catalogs')
+    manyparser.add_argument('catalogs', nargs='+', metavar='catalog',
+            help='the catalogs to merge, the first one is merged to')
+
+    statparser = subparsers.add_parser('stat', description=stat_catalogs.__doc__)
+    statparser.set_defaults(function=stat_catalogs)
+    statparser.add_argument('--json', dest='json', action='store_true',
+            help='print the counts as JSON object')
+    _add_cache_arguments(statparser)
+    statparser.add_argument('old', help='the old version of the catalog')
+    statparser.add_argument('new', help='the new version of the catalog')
+
+    watchparser = subparsers.add_parser('watch', description=watch.__doc__)
+    watchparser.set_defaults(function=watch)
+    watchparser.add_argument('-i', '--interval', dest='interval',
+            type=float, default=2.0, metavar='SECONDS',
+            help='how often to check the files (default 2)')
+    watchparser.add_argument('-c', '--compact', dest='compact',
+            action='store_true',
+            help='keep the catalogs in compact form to save memory')
+    watchparser.add_argument('--cache-size', dest='cache_size',
+            metavar='MB', type=int, default=256,
+            help='memory for parsed catalogs in MiB of catalog files '
+            '(default 256)')
+    _add_obsolete_arguments(watchparser)
+    watchparser.add_argument('files', nargs='+', metavar='file',
+            help='base, local and remote catalog of each watched merge')
+
+    updateparser = subparsers.add_parser('update', description=update.__doc__)
+    updateparser.set_defaults(function=update)
+    outgrp = updateparser.add_mutually_exclusive_group()
+    outgrp.add_argument('-o', '--out', '--output', dest='out',
+            help='output file (defaults to standard output)')
+    outgrp.add_argument('-U', '--update', dest='update',
+            action='store_true', help='write output over the catalogs')
+    updateparser.add_argument('template', help='the template (.pot)')
+    updateparser.add_argument('catalogs', nargs='+', metavar='catalog',
+            help='the catalogs to update')
+
     args = parser.parse_args()
     args.function(args)
 
@@ -19,13 +19,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
+import errno
+import io
+import os
+import sys
+
 import pytest
 
 import podiffutils
 
-from translate.misc.wStringIO import StringIO
 from translate.storage.pypo import pofile
 
+def _bytes(text):
+    """Return catalog text as bytes; the literals are bytes in Python 2."""
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+def _data(text):
+    return bytearray(_bytes(text))
+
+def _stream(text):
+    return io.BytesIO(_bytes(text))
+
+def _dump(store):
+    """Return store converted to bytes by Translate Toolkit itself."""
+    if str is bytes:
+        return str(store)
+    return bytes(store)
+
 def test_set_matcher3():
     """Simple test for the set matcher."""
     base = ['a', 'b', 'c', 'd']
@@ -50,18 +72,72 @@ def test_set_matcher3():
     res = list(merger.match())
     assert exp == res
 
+def test_set_matcher_n():
+    """Test that N-way matcher orders like the 3-way one."""
+    base = ['a', 'b', 'c', 'd']
+    local = ['a', 'c', 'b', 'e', '~d']
+    remote = ['b', 'c', '~d', '~a']
+    other = ['f', 'a', 'b', 'c', 'd', 'g']
+
+    def keyfunc(x):
+        return x[1:] if x.startswith('~') else x
+    def deletedfunc(x):
+        return x.startswith('~')
+
+    merger = podiffutils.SetMatcherN(base, [local, remote], keyfunc,
+            deletedfunc)
+    assert list(podiffutils.SetMatcher3(base, local, remote, keyfunc,
+            deletedfunc).match()) == list(merger.match())
+
+    merger = podiffutils.SetMatcherN(base, [local, remote, other], keyfunc,
+            deletedfunc)
+    # d is deleted in the first side, but not in the last, so it is
+    # inserted where it is there like the entries only the last side has
+    exp = [
+            (None, None, None, 'f'),
+            ('a', 'a', '~a', 'a'),
+            ('c', 'c', 'c', 'c'),
+            ('b', 'b', 'b', 'b'),
+            ('d', '~d', '~d', 'd'),
+            (None, None, None, 'g'),
+            (None, 'e', None, None),
+            ]
+    assert exp == list(merger.match())
+
 def do_test_po_merge(basetext, localtext, remotetext, expectedtext,
         expectedconflicts=0):
     differ = podiffutils.get_differ(pofile)()
 
     def load_string(string):
-        stream = StringIO(string)
+        stream = _stream(string)
         return differ.load_storage(stream)
 
     out, c = differ.merge(base=load_string(basetext),
             local=load_string(localtext),
             remote=load_string(remotetext))
-    assert expectedtext == str(out)
+    expectedtext = _bytes(expectedtext)
+    assert expectedtext == _dump(out)
+    assert expectedtext == differ.serialize(out)
+    assert expectedconflicts == c
+
+    def load_compact(string):
+        stream = _stream(string)
+        return differ.load_compact(stream)
+
+    out, c = differ.merge_compact(base=load_compact(basetext),
+            local=load_compact(localtext),
+            remote=load_compact(remotetext))
+    assert expectedtext == _dump(differ.expand_catalog(out))
+    assert expectedconflicts == c
+
+    result = differ.merge_text((_bytes(basetext), ''),
+            (_bytes(localtext), ''), (_bytes(remotetext), ''))
+    if result is not None:
+        assert (expectedtext, expectedconflicts) == result
+
+    out, c = differ.merge_many(load_string(basetext),
+            [load_string(localtext), load_string(remotetext)])
+    assert expectedtext == _dump(out)
     assert expectedconflicts == c
 
 def test_po_add():
@@ -524,3 +600,1011 @@ msgid "foo"
 msgstr ""
 ''',
 1)
+
+def test_po_delete_both():
+    """Test deletion on both sides."""
+    do_test_po_merge(
+'''msgid "foo"
+msgstr "FOO"
+
+msgid "bar"
+msgstr "BAR"
+''',
+'''msgid "foo"
+msgstr "FOO"
+''',
+'''msgid "foo"
+msgstr "FOO"
+''',
+'''msgid "foo"
+msgstr "FOO"
+''')
+
+def test_interning():
+    """Test that equal strings in different stores are shared."""
+    differ = podiffutils.get_differ(pofile)()
+    text = '''#: here:4
+msgid "foo"
+msgstr "bar"
+'''
+    first = differ.load_storage(_stream(text))
+    second = differ.load_storage(_stream(text))
+    assert first.units[0].msgid[0] is second.units[0].msgid[0]
+    assert first.units[0].sourcecomments[0] is second.units[0].sourcecomments[0]
+    assert first.units[0].msgstr[0] is second.units[0].msgstr[0]
+
+def test_compact_roundtrip():
+    """Test that converting to compact catalog and back preserves units."""
+    text = r'''# The Project.
+msgid ""
+msgstr ""
+"Project-Id-Version: Package -42\n"
+"Content-Type: text/plain; charset=utf-8\n"
+
+#. Translator, please
+#. make a silly comment.
+#: here:4 there:5
+#, c-format
+msgctxt "ctx"
+msgid "%d file"
+msgid_plural "%d files"
+msgstr[0] "%d soubor"
+msgstr[1] "%d soubory"
+msgstr[2] "%d souboru"
+
+#, fuzzy
+#| msgid "fo"
+msgid ""
+"foo "
+"bar"
+msgstr "FOO"
+
+#~ msgid "gone"
+#~ msgstr "pryc"
+'''
+    differ = podiffutils.get_differ(pofile)()
+    catalog = differ.load_compact(_stream(text))
+    assert _bytes(text) == _dump(differ.expand_catalog(catalog))
+
+@pytest.mark.parametrize('jobs', [1, 3])
+@pytest.mark.parametrize('compact', [False, True])
+def test_merge_session(compact, jobs):
+    """Test that merge session caches catalogs and does not modify them."""
+    base = _data('''msgid "foo"
+msgstr "FOO"
+
+msgid "bar"
+msgstr "BAR"
+''')
+    local = _data('''msgid "foo"
+msgstr "Foo"
+''')
+    remote = _data('''msgid "foo"
+msgstr "foo!"
+
+msgid "bar"
+msgstr "BAR"
+''')
+    session = podiffutils.MergeSession(compact=compact, jobs=jobs)
+    def text(store):
+        if compact:
+            store = session.differ.expand_catalog(store)
+        return _dump(store)
+    cached = session.load_many((base, local, remote))
+    texts = [text(c) for c in cached]
+    out, c = session.merge(base, local, remote)
+    assert 1 == c
+    assert _dump(out).startswith(b'#, fuzzy\nmsgid "foo"\n')
+    assert _dump(out).endswith(b'#~ msgid "bar"\n#~ msgstr "BAR"\n')
+    for t, c in zip((base, local, remote), cached):
+        assert session.load(t) is c
+    assert texts == [text(c) for c in cached]
+    again, c = session.merge(base, local, remote)
+    assert _dump(out) == _dump(again)
+
+def test_merge_session_buffers():
+    """Test that bytes and memoryview are content in Python 3."""
+    if sys.version_info[0] < 3:
+        pytest.skip('bytes are file names in Python 2')
+    base = b'msgid "foo"\nmsgstr "FOO"\n'
+    local = b'msgid "foo"\nmsgstr "Foo"\n'
+    session = podiffutils.MergeSession()
+    out, c = session.merge(base, memoryview(local), bytearray(base))
+    assert 0 == c
+    assert local == _dump(out)
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_merge_session_eviction(compact):
+    """Test that merge session drops least recently used catalogs."""
+    session = podiffutils.MergeSession(cache_size=50, compact=compact)
+    first = session.load(_data('msgid "foo"\nmsgstr "FOO"\n'))
+    second = session.load(_data('msgid "bar"\nmsgstr "BAR"\n'))
+    assert session.load(_data('msgid "bar"\nmsgstr "BAR"\n')) is second
+    third = session.load(_data('msgid "baz"\nmsgstr "BAZ"\n'))
+    assert session.load(_data('msgid "baz"\nmsgstr "BAZ"\n')) is third
+    assert session.load(_data('msgid "foo"\nmsgstr "FOO"\n')) is not first
+    out, c = session.merge(_data('msgid "baz"\nmsgstr "BAZ"\n'),
+            _data('msgid "baz"\nmsgstr "BAZ"\n'),
+            _data('msgid "baz"\nmsgstr "Baz"\n'))
+    assert b'msgid "baz"\nmsgstr "Baz"\n' == _dump(out)
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_merge_session_eviction_in_use(compact):
+    """Test that catalogs being merged survive eviction of others."""
+    base = _data('msgid "foo"\nmsgstr "FOO"\n')
+    local = _data('msgid "foo"\nmsgstr "FOO"\n\n'
+                  'msgid "locale"\nmsgstr "LOCAL"\n\n'
+                  'msgid "extra"\nmsgstr "EXTRA"\n')
+    remote = _data('msgid "foo"\nmsgstr "FOO"\n\nmsgid "qu"\nmsgstr "QU"\n')
+    assert (25, 86, 49) == (len(base), len(local), len(remote))
+    session = podiffutils.MergeSession(cache_size=60, compact=compact)
+    out, c = session.merge(base, local, remote)
+    assert 0 == c
+    expected, c = podiffutils.MergeSession().merge(base, local, remote)
+    assert _dump(expected) == _dump(out)
+
+@pytest.mark.parametrize('prefilter', [False, True])
+@pytest.mark.parametrize('compact', [False, True])
+def test_merge_session_pool_size(compact, prefilter):
+    """Test that strings of catalogs that are not cached are not kept."""
+    session = podiffutils.MergeSession(cache_size=100, compact=compact,
+            prefilter=prefilter)
+    session.pool_slack = 100
+    for i in range(20):
+        text = ''.join('msgid "%d-%d"\nmsgstr "%d"\n\n' % (i, j, j)
+                       for j in range(50))
+        out, c = session.merge(_data(text), _data(text),
+                _data(text + 'msgid "new"\nmsgstr "NEW"\n'))
+        assert 0 == c
+        assert len(session.differ.strings) <= session.pool_slack
+
+def test_conflict_index():
+    """Test that conflicts are recorded with their lines."""
+    session = podiffutils.MergeSession()
+    index = []
+    out, c = session.merge(_data(r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package -42\n"
+"PO-Revision-Date: 2013-12-11 11:40+0100\n"
+
+msgid "foo"
+msgstr "bar"
+
+msgctxt "ctx"
+msgid "foo"
+msgstr "bar"
+'''), _data(r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package -41\n"
+"PO-Revision-Date: 2013-12-11 11:50+0100\n"
+
+msgid "foo"
+msgstr "bar"
+
+msgctxt "ctx"
+msgid "foo"
+msgstr "baz"
+'''), _data(r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package -40\n"
+"PO-Revision-Date: 2013-12-11 11:45+0100\n"
+
+msgid "foo"
+msgstr "bar"
+
+msgctxt "ctx"
+msgid "foo"
+msgstr "qyzzy"
+'''), conflict_index=index)
+    text = session.serialize(out, index).decode('utf-8')
+    assert 2 == c
+    lines = text.split('\n')
+    header, revision, translation = index
+    assert 'header' == header['kind']
+    assert 'Project-Id-Version' == header['key']
+    assert 'local' == header['winner']
+    assert 1 == header['line']
+    assert 'PO-Revision-Date' == revision['key']
+    assert 'local' == revision['winner']
+    assert 'translation' == translation['kind']
+    assert 'ctx' == translation['msgctxt']
+    assert 'foo' == translation['msgid']
+    assert translation['winner'] is None
+    assert '#, fuzzy' == lines[translation['line'] - 1]
+    assert 'msgctxt "ctx"' == lines[translation['line']]
+
+def test_merge_many():
+    """Test N-way merge lists all conflicting sides."""
+    def catalog(project, foo, baz, qux=True):
+        text = (r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package %s\n"
+"Content-Type: text/plain; charset=UTF-8\n"
+
+msgid "foo"
+msgstr "%s"
+
+msgid "baz"
+msgstr "%s"
+''' % (project, foo, baz))
+        if qux:
+            text += '\nmsgid "qux"\nmsgstr "QUX"\n'
+        return text
+
+    differ = podiffutils.get_differ(pofile)()
+    def load_string(string):
+        return differ.load_storage(_stream(string))
+    out, c = differ.merge_many(load_string(catalog('1', 'bar', 'BAZ')), [
+        load_string(catalog('1', 'one', 'BAZ')),
+        load_string(catalog('2', 'two', 'Baz!')),
+        load_string(catalog('3', 'one', 'BAZ', qux=False)),
+        ])
+    assert 2 == c
+    assert r'''# (conflict) remote 2 (Package 3): Project-Id-Version: Package 3
+msgid ""
+msgstr ""
+"Project-Id-Version: Package 2\n"
+"Content-Type: text/plain; charset=UTF-8\n"
+
+#, fuzzy
+msgid "foo"
+msgstr ""
+"#-#-#-#-#  local (Package 1)  #-#-#-#-#\n"
+"one\n"
+"#-#-#-#-#  remote 1 (Package 2)  #-#-#-#-#\n"
+"two\n"
+
+msgid "baz"
+msgstr "Baz!"
+
+#~ msgid "qux"
+#~ msgstr "QUX"
+''' == _dump(out).decode('utf-8')
+
+def test_stat():
+    """Test counting changes between catalog versions."""
+    old = r'''msgid ""
+msgstr ""
+"Content-Type: text/plain; charset=UTF-8\n"
+
+msgid "kept"
+msgstr "Kept"
+
+msgid "changed"
+msgstr "Changed"
+
+msgid "fuzzied"
+msgstr "Fuzzied"
+
+msgid "translated"
+msgstr ""
+
+msgid "unfuzzied"
+msgid_plural "unfuzzied"
+msgstr[0] "Unfuzzied"
+msgstr[1] "Unfuzzied"
+
+msgid "removed"
+msgstr "Removed"
+
+msgid "obsoleted"
+msgstr "Obsoleted"
+'''
+    new = r'''msgid ""
+msgstr ""
+"Content-Type: text/plain; charset=UTF-8\n"
+
+msgid "kept"
+msgstr "Kept"
+
+msgid "changed"
+msgstr "Modified"
+
+#, fuzzy
+msgid "fuzzied"
+msgstr "Fuzzied"
+
+msgid "translated"
+msgstr "Translated"
+
+msgid "unfuzzied"
+msgid_plural "unfuzzied"
+msgstr[0] "Unfuzzied"
+msgstr[1] "Unfuzzied"
+
+msgid "added"
+msgstr ""
+
+#~ msgid "obsoleted"
+#~ msgstr "Obsoleted"
+'''
+    old = old.replace('msgid "unfuzzied"', '#, fuzzy\nmsgid "unfuzzied"', 1)
+    session = podiffutils.MergeSession(compact=True)
+    counts = session.differ.stat(*session.load_many((_data(old),
+        _data(new))))
+    assert {'added': 1, 'removed': 2, 'changed': 2, 'fuzzied': 1,
+            'translated': 2} == counts
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_prune_obsolete(compact):
+    """Test limiting obsolete entries in merge."""
+    base = '''msgid "Open file"
+msgstr "Otevrit soubor"
+
+msgid "Close window"
+msgstr "Zavrit okno"
+
+msgid "Print"
+msgstr "Tisk"
+
+#~ msgid "Open files"
+#~ msgstr "Otevrit soubory"
+
+#~ msgid "Quit"
+#~ msgstr "Konec"
+'''
+    local = '''msgid "Open file"
+msgstr "Otevrit soubor"
+
+msgid "Close window"
+msgstr "Zavrit okno"
+
+#~ msgid "Print"
+#~ msgstr "Tisk"
+
+#~ msgid "Open files"
+#~ msgstr "Otevrit soubory"
+
+#~ msgid "Quit"
+#~ msgstr "Konec"
+'''
+
+    def obsolete(**options):
+        session = podiffutils.MergeSession(compact=compact, **options)
+        data, c = session.merge_to_string(_data(base),
+                _data(local), _data(base))
+        return [line[len('#~ msgid "'):-1]
+                for line in data.decode('utf-8').split('\n')
+                if line.startswith('#~ msgid')]
+
+    assert ['Print', 'Open files', 'Quit'] == obsolete()
+    assert [] == obsolete(max_obsolete=0)
+    assert ['Print', 'Open files'] == obsolete(max_obsolete=2)
+    assert ['Open files'] == obsolete(obsolete_similarity=0.8)
+    assert [] == obsolete(obsolete_similarity=0.8, max_obsolete=0)
+    with pytest.raises(ValueError):
+        obsolete(max_obsolete=-1)
+    for ratio in (-0.1, 7):
+        with pytest.raises(ValueError):
+            obsolete(obsolete_similarity=ratio)
+
+@pytest.mark.parametrize('option', [['--max-obsolete', '-1'],
+    ['--obsolete-similarity', '7'], ['--obsolete-similarity', '-0.5']])
+def test_obsolete_arguments(monkeypatch, option):
+    """Test that out of range obsolete pruning options are rejected."""
+    monkeypatch.setattr('sys.argv', ['podiffutils.py', 'merge'] + option +
+        ['base.po', 'local.po', 'remote.po'])
+    with pytest.raises(SystemExit) as e:
+        podiffutils.main()
+    assert 2 == e.value.code
+
+def _prefilter_catalog(translations):
+    return '\n'.join([r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package\n"
+"Content-Type: text/plain; charset=UTF-8\n"
+'''] + ['''#: a.c:%d b.c:%d
+msgid "message %d"
+msgstr "%s"
+''' % (i, i, i, t) for i, t in translations])
+
+def test_prefilter():
+    """Test that prefilter merges changed entries and copies the rest."""
+    base = [(i, 'zprava %d' % i) for i in range(30)]
+    local = list(base)
+    local[10] = (10, 'local')
+    local[25] = (25, 'local')
+    remote = list(base)
+    remote[20] = (20, 'remote')
+    remote[25] = (25, 'remote')
+    session = podiffutils.MergeSession(prefilter=True)
+    index = []
+    text, c = session.merge_to_string(
+            _data(_prefilter_catalog(base)),
+            _data(_prefilter_catalog(local)),
+            _data(_prefilter_catalog(remote)), conflict_index=index)
+    text = text.decode('utf-8')
+    assert 1 == c
+    # merging puts each location on its own line, so only the three merged
+    # entries have them split
+    assert 3 == text.count('\n#: b.c:')
+    assert 'msgid "message 10"\nmsgstr "local"\n' in text
+    assert 'msgid "message 20"\nmsgstr "remote"\n' in text
+    lines = text.split('\n')
+    record, = index
+    assert '#: a.c:25' == lines[record['line'] - 1]
+    assert '#, fuzzy' == lines[record['line'] + 1]
+    assert 'msgid "message 25"' == lines[record['line'] + 2]
+
+    # moving an entry needs the full merge
+    local.append(local.pop(5))
+    differ = session.differ
+    assert differ.merge_text((_bytes(_prefilter_catalog(base)), ''),
+            (_bytes(_prefilter_catalog(local)), ''),
+            (_bytes(_prefilter_catalog(remote)), '')) is None
+    out, c = session.merge(_data(_prefilter_catalog(base)),
+            _data(_prefilter_catalog(local)),
+            _data(_prefilter_catalog(remote)))
+    assert (session.serialize(out), c) == session.merge_to_string(
+            _data(_prefilter_catalog(base)),
+            _data(_prefilter_catalog(local)),
+            _data(_prefilter_catalog(remote)))
+
+def test_pipeline():
+    """Test that pipelined merge gives the same result as sequential one."""
+    base = [(i, 'zprava %d' % i) for i in range(100)]
+    local = [(i, 'local' if i % 7 == 0 else t) for i, t in base if i % 11]
+    remote = [(i, 'remote' if i % 5 == 0 else t) for i, t in base if i % 13]
+    texts = [_prefilter_catalog(c) for c in (base, local, remote)]
+    sequential = podiffutils.MergeSession()
+    index = []
+    expected = sequential.merge_to_string(conflict_index=index,
+            *[_data(t) for t in texts])
+    assert expected[1] > 0
+    pipelined = podiffutils.MergeSession(pipeline=True)
+    # small queue makes the stages wait for each other
+    pipelined.pipeline_queue_size = 2
+    pipelined.pipeline_batch_size = 3
+    pipelined_index = []
+    assert expected == pipelined.merge_to_string(
+            conflict_index=pipelined_index, *[_data(t) for t in texts])
+    assert index == pipelined_index
+
+    with pytest.raises(IOError):
+        pipelined.merge_to_string(_data(texts[0]), '/nonexistent.po',
+                _data(texts[2]))
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_merge_bases(compact):
+    """Test merge with several merge bases."""
+    def catalog(*entries):
+        return _data('\n'.join('msgid "%s"\nmsgstr "%s"\n' % e
+            for e in entries))
+    bases = [
+            catalog(('a', 'A'), ('b', 'B'), ('d', 'D1')),
+            catalog(('a', 'A'), ('c', 'C'), ('d', 'D2')),
+            ]
+    local = catalog(('a', 'A local'), ('b', 'B'), ('c', 'C'), ('d', 'D2'))
+    remote = catalog(('a', 'A'), ('b', 'B'), ('d', 'D2'))
+    session = podiffutils.MergeSession(compact=compact)
+    index = []
+    data, c = session.merge_to_string(bases, local, remote,
+            conflict_index=index)
+    # c was in a base, so remote deleted it; the bases conflict on d, but
+    # that does not matter when local and remote agree
+    assert (b'msgid "a"\nmsgstr "A local"\n\n'
+            b'msgid "b"\nmsgstr "B"\n\n'
+            b'msgid "d"\nmsgstr "D2"\n\n'
+            b'#~ msgid "c"\n#~ msgstr "C"\n', 0) == (data, c)
+    assert [] == index
+    # single base in a list is the same as plain 3-way merge
+    assert (session.merge_to_string(bases[0], local, remote) ==
+            session.merge_to_string(bases[:1], local, remote))
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_merge_bases_no_obsolete(tmpdir, monkeypatch, compact):
+    """Test that pruning obsolete entries does not apply to virtual base."""
+    texts = {
+            'base1': 'msgid "a"\nmsgstr "A"\n\n#~ msgid "x"\n#~ msgstr "X"\n',
+            'base2': 'msgid "a"\nmsgstr "A2"\n\n#~ msgid "x"\n#~ msgstr "X"\n',
+            'local': 'msgid "a"\nmsgstr "A2"\n\nmsgid "x"\nmsgstr "X"\n',
+            'remote': 'msgid "a"\nmsgstr "A2"\n\n#~ msgid "x"\n#~ msgstr "X"\n',
+            }
+    for name, text in texts.items():
+        tmpdir.join(name + '.po').write_binary(_bytes(text))
+    path = lambda name: str(tmpdir.join(name + '.po'))
+    argv = ['podiffutils.py', 'merge', '--no-obsolete', '-o', path('out'),
+            path('base1'), path('local'), path('remote')]
+    if compact:
+        argv.insert(2, '-c')
+    monkeypatch.setattr('sys.argv', argv)
+    podiffutils.main()
+    expected = tmpdir.join('out.po').read_binary()
+    assert b'msgid "x"\nmsgstr "X"\n' in expected
+    monkeypatch.setattr('sys.argv',
+            argv[:2] + ['--extra-base', path('base2')] + argv[2:])
+    podiffutils.main()
+    assert expected == tmpdir.join('out.po').read_binary()
+
+def test_watch(tmpdir, monkeypatch):
+    """Test that watcher merges only when files change."""
+    texts = {
+            'base': b'msgid "foo"\nmsgstr "FOO"\n\nmsgid "bar"\nmsgstr "BAR"\n',
+            'local': b'msgid "foo"\nmsgstr "Foo"\n\nmsgid "bar"\nmsgstr "BAR"\n',
+            'remote': b'msgid "foo"\nmsgstr "FOO"\n\nmsgid "bar"\nmsgstr "Bar"\n',
+            }
+    paths = {}
+    for name, text in texts.items():
+        paths[name] = tmpdir.join(name + '.po')
+        paths[name].write_binary(text)
+    watcher = podiffutils.MergeWatcher([[str(paths[name])
+        for name in ('base', 'local', 'remote')]])
+    parsed = []
+    parse = watcher.session._parse
+    monkeypatch.setattr(watcher.session, '_parse',
+            lambda data, name: parsed.append(name) or parse(data, name))
+
+    assert [(str(paths['local']), 0, None)] == watcher.poll()
+    assert (b'msgid "foo"\nmsgstr "Foo"\n\nmsgid "bar"\nmsgstr "Bar"\n'
+            == paths['local'].read_binary())
+    assert 3 == len(parsed)
+    assert [] == watcher.poll()
+    # touching file does not count as change
+    paths['base'].setmtime(1000000000)
+    assert [] == watcher.poll()
+
+    # only the changed file is parsed; the merged local is kept in memory
+    paths['remote'].write_binary(texts['remote'].replace(b'"FOO"', b'"Foo!"'))
+    del parsed[:]
+    assert [(str(paths['local']), 1, None)] == watcher.poll()
+    assert [str(paths['remote'])] == parsed
+    assert b'#, fuzzy' in paths['local'].read_binary()
+    assert [] == watcher.poll()
+
+    # broken file is reported and retried when it changes
+    paths['remote'].write_binary(b'\x1f\x8b not really gzip')
+    (local, conflicts, error), = watcher.poll()
+    assert error is not None
+    assert [] == watcher.poll()
+    paths['remote'].write_binary(texts['remote'])
+    assert [(str(paths['local']), 0, None)] == watcher.poll()
+
+def test_watch_chained(tmpdir):
+    """Test that triples using a merged local as input are merged too."""
+    paths = dict((name, tmpdir.join(name + '.po'))
+            for name in ('b1', 'l1', 'r1', 'b2', 'l2'))
+    for name in ('b1', 'l1', 'r1', 'b2', 'l2'):
+        paths[name].write_binary(b'msgid "a"\nmsgstr "A"\n')
+    watcher = podiffutils.MergeWatcher([
+        [str(paths[name]) for name in ('b1', 'l1', 'r1')],
+        [str(paths[name]) for name in ('b2', 'l2', 'l1')]])
+    assert 2 == len(watcher.poll())
+    assert [] == watcher.poll()
+
+    paths['r1'].write_binary(b'msgid "a"\nmsgstr "A new"\n')
+    assert [(str(paths['l1']), 0, None),
+            (str(paths['l2']), 0, None)] == watcher.poll()
+    for name in ('l1', 'l2'):
+        assert b'msgid "a"\nmsgstr "A new"\n' == paths[name].read_binary()
+    assert [] == watcher.poll()
+
+    # triple merged earlier in the poll is merged again in the next one
+    watcher.triples.reverse()
+    for name in ('b1', 'b2'):
+        paths[name].write_binary(b'msgid "a"\nmsgstr "A new"\n')
+    paths['r1'].write_binary(b'msgid "a"\nmsgstr "A newer"\n')
+    assert [(str(paths['l2']), 0, None),
+            (str(paths['l1']), 0, None)] == watcher.poll()
+    assert [(str(paths['l2']), 0, None)] == watcher.poll()
+    assert b'msgid "a"\nmsgstr "A newer"\n' == paths['l2'].read_binary()
+    assert [] == watcher.poll()
+
+def do_test_po_update(text, templatetext, expectedtext):
+    differ = podiffutils.get_differ(pofile)()
+    template = differ.load_storage(_stream(templatetext))
+    out = differ.update(differ.load_storage(_stream(text)), template)
+    assert _bytes(expectedtext) == _dump(out)
+    # the template must be reusable
+    assert _bytes(templatetext) == _dump(template)
+
+def test_update():
+    """Test updating catalog from template."""
+    do_test_po_update(
+r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package -42\n"
+"POT-Creation-Date: 2013-12-11 11:30+0100\n"
+"Language: cs\n"
+
+#. Old comment
+#: old.c:1
+msgid "foo"
+msgstr "FOO"
+
+#: old.c:2
+#, fuzzy, c-format
+msgid "bar %s"
+msgstr "BAR %s"
+
+#: old.c:3
+msgid "gone"
+msgstr "pryc"
+
+#~ msgid "back"
+#~ msgstr "zpet"
+''',
+r'''#, fuzzy
+msgid ""
+msgstr ""
+"Project-Id-Version: PACKAGE VERSION\n"
+"POT-Creation-Date: 2013-12-12 10:00+0100\n"
+"Language: \n"
+
+#: new.c:1
+#, c-format
+msgid "bar %s"
+msgstr ""
+
+#. New comment
+#: new.c:2
+msgid "foo"
+msgstr ""
+
+#: new.c:3
+msgid "new"
+msgstr ""
+
+#: new.c:4
+msgid "back"
+msgstr ""
+''',
+r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package -42\n"
+"POT-Creation-Date: 2013-12-12 10:00+0100\n"
+"Language: cs\n"
+
+#: new.c:1
+#, fuzzy, c-format
+msgid "bar %s"
+msgstr "BAR %s"
+
+#. New comment
+#: new.c:2
+msgid "foo"
+msgstr "FOO"
+
+#: new.c:3
+msgid "new"
+msgstr ""
+
+#: new.c:4
+msgid "back"
+msgstr "zpet"
+
+#~ msgid "gone"
+#~ msgstr "pryc"
+''')
+
+def test_write_file(tmpdir):
+    """Test that unchanged output is not written and changed is replaced."""
+    path = tmpdir.join('out.po')
+    assert podiffutils._write_file(str(path), b'msgid "foo"\n')
+    path.chmod(0o640)
+    path.setmtime(1000000000)
+    assert not podiffutils._write_file(str(path), b'msgid "foo"\n')
+    assert 1000000000 == path.mtime()
+    assert podiffutils._write_file(str(path), b'msgid "bar"\n')
+    assert b'msgid "bar"\n' == path.read_binary()
+    assert 0o640 == path.stat().mode & 0o777
+    assert ['out.po'] == [p.basename for p in tmpdir.listdir()]
+    # new file gets the default permissions
+    umask = os.umask(0o027)
+    try:
+        assert podiffutils._write_file(str(tmpdir.join('new.po')), b'')
+    finally:
+        os.umask(umask)
+    assert 0o640 == tmpdir.join('new.po').stat().mode & 0o777
+
+@pytest.mark.parametrize('extension', ['.gz', '.bz2', '.xz'])
+def test_compressed(tmpdir, extension):
+    """Test reading and writing compressed catalogs."""
+    if extension == '.xz' and podiffutils.lzma is None:
+        pytest.skip('lzma module is not available')
+    texts = [
+            b'msgid "foo"\nmsgstr "FOO"\n',
+            b'msgid "foo"\nmsgstr "Foo"\n',
+            b'msgid "foo"\nmsgstr "FOO"\n\nmsgid "bar"\nmsgstr "BAR"\n',
+            ]
+    paths = []
+    for name, text in zip(('base', 'local', 'remote'), texts):
+        path = str(tmpdir.join(name + '.po' + extension))
+        podiffutils._write_output(path, text)
+        paths.append(path)
+    assert texts[0] != open(paths[0], 'rb').read()
+    differ = podiffutils.get_differ(pofile)()
+    assert texts[0] == _dump(differ.load_storage(paths[0]))
+    session = podiffutils.MergeSession()
+    data, c = session.merge_to_string(*paths)
+    assert b'msgid "foo"\nmsgstr "Foo"\n\nmsgid "bar"\nmsgstr "BAR"\n' == data
+    # compressing the same data again gives the same file, so it is not
+    # rewritten
+    out = str(tmpdir.join('out.po' + extension))
+    podiffutils._write_output(out, data)
+    assert not podiffutils._write_file(out,
+            podiffutils._compress(out, data))
+    assert data == podiffutils._read_catalog(out)[0]
+
+def _read_mo(data):
+    """Read MO data to dict, checking that hash table finds all keys."""
+    import struct
+    from translate.storage.mo import hashpjw
+    magic, version, count, keys, values, hash_size, hashes = struct.unpack(
+            'Iiiiiii', data[:28])
+    assert 0x950412de == magic
+    def string(table, i):
+        length, offset = struct.unpack('II', data[table + 8 * i:table + 8 * i + 8])
+        return data[offset:offset + length]
+    messages = dict((string(keys, i), string(values, i))
+            for i in range(count))
+    assert sorted(messages) == [string(keys, i) for i in range(count)]
+    for key in messages:
+        value = hashpjw(key.split(b'\0')[0])
+        cursor = value % hash_size
+        while True:
+            i, = struct.unpack('I', data[hashes + 4 * cursor:hashes + 4 * cursor + 4])
+            assert i != 0
+            if string(keys, i - 1) == key:
+                break
+            cursor = (cursor + 1 + value % (hash_size - 2)) % hash_size
+    return messages
+
+def test_compile_mo():
+    """Test compiling merged catalog to MO."""
+    text = u'''msgid ""
+msgstr ""
+"Project-Id-Version: Package\\n"
+"Content-Type: text/plain; charset=UTF-8\\n"
+
+msgid "translated"
+msgstr "p\u0159elo\u017eeno"
+
+#, fuzzy
+msgid "fuzzy"
+msgstr "Fuzzy"
+
+msgid "untranslated"
+msgstr ""
+
+msgctxt "menu"
+msgid "File"
+msgstr "Soubor"
+
+msgid "one file"
+msgid_plural "%d files"
+msgstr[0] "jeden soubor"
+msgstr[1] "%d soubory"
+msgstr[2] "%d soubor\u016f"
+
+#~ msgid "obsolete"
+#~ msgstr "Zastaral\u00e9"
+'''.encode('utf-8')
+    session = podiffutils.MergeSession()
+    out, c = session.merge(_data(text), _data(text), _data(text))
+    messages = _read_mo(session.differ.compile_mo(out))
+    assert {
+            b'': b'Project-Id-Version: Package\n'
+                b'Content-Type: text/plain; charset=UTF-8\n',
+            b'translated': u'p\u0159elo\u017eeno'.encode('utf-8'),
+            b'menu\x04File': b'Soubor',
+            b'one file\0%d files': u'jeden soubor\0%d soubory\0%d soubor\u016f'.encode('utf-8'),
+            } == messages
+
+# Hash tables of MO files written by GNU msgfmt for catalogs with these
+# msgids: python-apt and systemd translations from Debian and a tornado test
+# catalog with contexts and plurals. The table only depends on the msgids.
+_msgfmt_hash_tables = [
+    ('''msgid "Details"
+msgstr "X"
+
+msgid "Officially supported"
+msgstr "X"
+
+msgid "Restricted copyright"
+msgstr "X"
+''', (1, 3, 0, 2, 4)),
+    ('''msgid "Set hostname"
+msgstr "X"
+
+msgid "Create a home area"
+msgstr "X"
+
+msgid "Set machine information"
+msgstr "X"
+
+msgid "Send passphrase back to system"
+msgstr "X"
+''', (1, 0, 2, 4, 0, 3, 5)),
+    ('''msgid "school"
+msgstr "X"
+
+msgctxt "law"
+msgid "right"
+msgstr "X"
+
+msgctxt "good"
+msgid "right"
+msgstr "X"
+
+msgctxt "stick"
+msgid "club"
+msgid_plural "clubs"
+msgstr[0] "X"
+msgstr[1] "X"
+
+msgctxt "organization"
+msgid "club"
+msgid_plural "clubs"
+msgstr[0] "X"
+msgstr[1] "X"
+''', (1, 0, 0, 3, 6, 0, 2, 4, 0, 5, 0)),
+]
+
+@pytest.mark.parametrize('text, expected', _msgfmt_hash_tables)
+def test_compile_mo_hash_table(text, expected):
+    """Test that MO hash table is laid out exactly like msgfmt does."""
+    import struct
+    header = 'msgid ""\nmsgstr "Content-Type: text/plain; charset=UTF-8\\n"\n\n'
+    differ = podiffutils.get_differ(pofile)()
+    data = differ.compile_mo(differ.load_storage(_stream(header + text)))
+    hash_size, hashes = struct.unpack('ii', data[20:28])
+    assert expected == struct.unpack('%dI' % hash_size,
+            data[hashes:hashes + 4 * hash_size])
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_parse_cache(tmpdir, monkeypatch, compact):
+    """Test that parsed catalogs are loaded from parse cache."""
+    texts = [_data('''msgid "foo"
+msgstr "%s"
+
+#, fuzzy
+msgid "bar"
+msgid_plural "bars"
+msgstr[0] "BAR"
+msgstr[1] "BARS"
+''' % t) for t in ('FOO', 'Foo', 'foo!')]
+    def merge():
+        session = podiffutils.MergeSession(compact=compact,
+                parse_cache=podiffutils.ParseCache(str(tmpdir)))
+        out, c = session.merge(*texts)
+        return _dump(out), c
+    expected = merge()
+    assert 3 == len(tmpdir.listdir())
+    cache = podiffutils.ParseCache(str(tmpdir))
+    strings, catalog = cache.get(bytes(texts[0]))
+    assert 2 == len(catalog)
+    with monkeypatch.context() as m:
+        m.setattr(podiffutils.MergeSession, '_parse', None)
+        assert expected == merge()
+    # damaged entry is replaced
+    tmpdir.listdir()[0].write_binary(b'garbage')
+    assert expected == merge()
+    assert all(p.read_binary() != b'garbage' for p in tmpdir.listdir())
+
+def test_parse_cache_eviction(tmpdir):
+    """Test that parse cache removes least recently used entries."""
+    differ = podiffutils.get_differ(pofile)()
+    cache = podiffutils.ParseCache(str(tmpdir), max_size=1)
+    for text in (b'msgid "foo"\nmsgstr "FOO"\n', b'msgid "bar"\nmsgstr "BAR"\n'):
+        cache.put(text, differ.strings, differ.load_compact(_stream(text)))
+    assert [] == tmpdir.listdir()
+
+def test_parse_cache_concurrent_removal(tmpdir, monkeypatch):
+    """Test that entries removed by another process count as evicted."""
+    differ = podiffutils.get_differ(pofile)()
+    text = b'msgid "foo"\nmsgstr "FOO"\n'
+    catalog = differ.load_compact(_stream(text))
+    cache = podiffutils.ParseCache(str(tmpdir))
+    cache.put(text, differ.strings, catalog)
+    def vanish(path, *args):
+        raise OSError(errno.ENOENT, 'No such file or directory', path)
+    listdir = os.listdir
+    with monkeypatch.context() as m:
+        m.setattr(os, 'utime', vanish)
+        strings, cached = cache.get(text)
+        assert 1 == len(cached)
+    tmpdir.listdir()[0].write_binary(b'garbage')
+    with monkeypatch.context() as m:
+        m.setattr(os, 'remove', vanish)
+        assert cache.get(text) is None
+        cache.max_size = 1
+        m.setattr(os, 'listdir', lambda path: listdir(path) + ['gone.cache'])
+        cache.put(text, differ.strings, catalog)
+
+class _CountingObserver(podiffutils.MergeObserver):
+    def __init__(self):
+        self.counts = {}
+        self.units = 0
+
+    def _count(self, *key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def unit_begin(self, base, local, remote):
+        self.units += 1
+
+    def unit_decision(self, decision):
+        self._count('unit', decision)
+
+    def target_decision(self, unit, decision):
+        self._count('target', decision)
+
+    def header_decision(self, key, rule, winner):
+        if rule is not None:
+            self._count('header', rule, winner)
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_observer(compact):
+    """Test that observer is told about merge decisions."""
+    session = podiffutils.MergeSession(compact=compact)
+    observer = _CountingObserver()
+    session.differ.observer = observer
+    session.merge(_data(r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package -42\n"
+"POT-Creation-Date: 2013-12-11 11:30+0100\n"
+"PO-Revision-Date: 2013-12-11 11:40+0100\n"
+
+msgid "same"
+msgstr "same"
+
+msgid "quality"
+msgstr ""
+
+msgid "both"
+msgstr "Both"
+
+msgid "deleted"
+msgstr "deleted"
+'''), _data(r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package -41\n"
+"POT-Creation-Date: 2013-12-11 11:30+0100\n"
+"PO-Revision-Date: 2013-12-11 11:50+0100\n"
+
+msgid "same"
+msgstr "same"
+
+#, fuzzy
+msgid "quality"
+msgstr "Fuzzy"
+
+msgid "both"
+msgstr "BOTH"
+
+msgid "deleted"
+msgstr "deleted"
+'''), _data(r'''msgid ""
+msgstr ""
+"Project-Id-Version: Package -40\n"
+"POT-Creation-Date: 2013-12-11 11:40+0100\n"
+"PO-Revision-Date: 2013-12-11 11:45+0100\n"
+
+msgid "same"
+msgstr "same"
+
+msgid "quality"
+msgstr "Done"
+
+msgid "both"
+msgstr "BOTH"
+
+msgid "new"
+msgstr "new"
+'''))
+    expected = {
+            ('unit', 'deleted'): 1,
+            ('unit', 'created'): 1,
+            ('target', 'remote-quality'): 1,
+            ('header', 'POT-Creation-Date', 'remote'): 1,
+            ('header', 'PO-Revision-Date', 'local'): 1,
+            }
+    if compact:
+        # units the same on both sides are not merged
+        expected[('unit', 'merged')] = 2
+        expected[('unit', 'copied')] = 2
+    else:
+        expected[('unit', 'merged')] = 4
+        expected[('target', 'remote')] = 1
+        expected[('target', 'same')] = 1
+    assert expected == observer.counts
+    assert (4 if compact else 6) == observer.units
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Jan Hudec <bulb@ucw.cz>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Tests that merge time and memory grow about linearly with catalog size.
+
+The merge is run on generated catalogs of size n, 4n and 16n. The number
+of function calls and the peak allocated memory for 4n may be at most
+TOLERANCE times more than 4 times those for n; both are repeatable, so the
+limit can be tight. Quadratic behaviour would make them 16 times more. The
+time for 16n is only checked with a wide margin, TIME_TOLERANCE times 16,
+because it is noisy, but it also catches quadratic work inside builtins,
+which would make it 256 times longer.
+
+The tests take a few minutes, so they only run when the PODIFFUTILS_SCALING
+environment variable is set:
+
+    PODIFFUTILS_SCALING=1 py.test test_scaling.py
+"""
+
+import gc
+import io
+import os
+import sys
+from timeit import default_timer
+
+import pytest
+
+import podiffutils
+from bench_podiffutils import make_catalogs, shapes
+
+from translate.storage.pypo import pofile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+pytestmark = pytest.mark.skipif(not os.environ.get('PODIFFUTILS_SCALING'),
+        reason='set PODIFFUTILS_SCALING=1 to run the scaling tests')
+
+SIZE = 250
+TOLERANCE = 1.5
+TIME_TOLERANCE = 3.0
+REPEAT = 3
+
+def _count_calls(merge, inputs):
+    """Return number of function calls merge(*inputs) makes."""
+    calls = [0]
+    def profile(frame, event, arg):
+        if event in ('call', 'c_call'):
+            calls[0] += 1
+    sys.setprofile(profile)
+    try:
+        merge(*inputs)
+    finally:
+        sys.setprofile(None)
+    return calls[0]
+
+def _merge(n, shape, compact):
+    """Return calls, peak allocated memory and best time of merges of size n."""
+    texts = make_catalogs(n, shape)
+    calls = peak = best = None
+    for i in range(REPEAT + 1):
+        differ = podiffutils.get_differ(pofile)()
+        if compact:
+            inputs = [differ.load_compact(io.BytesIO(t)) for t in texts]
+            merge = differ.merge_compact
+        else:
+            inputs = [differ.load_storage(io.BytesIO(t)) for t in texts]
+            merge = differ.merge
+        gc.collect()
+        if i == 0:
+            calls = _count_calls(merge, inputs)
+            continue
+        if tracemalloc is not None and i == 1:
+            tracemalloc.start()
+            merge(*inputs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            continue
+        start = default_timer()
+        merge(*inputs)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return calls, peak, best
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('shape', sorted(shapes))
+def test_linear_merge(shape, compact):
+    small_calls, small_memory, small_time = _merge(SIZE, shape, compact)
+    large_calls, large_memory, large_time = _merge(4 * SIZE, shape, compact)
+    assert large_calls < 4 * TOLERANCE * small_calls, (
+            'merge of %s catalogs makes %.1f times more calls for 4 times size' % (
+                shape, float(large_calls) / small_calls))
+    if tracemalloc is not None:
+        assert large_memory < 4 * TOLERANCE * small_memory, (
+                'merge of %s catalogs takes %.1f times more memory for 4 times size' % (
+                    shape, float(large_memory) / small_memory))
+    huge_time = _merge(16 * SIZE, shape, compact)[2]
+    assert huge_time < 16 * TIME_TOLERANCE * small_time, (
+            'merge of %s catalogs takes %.1f times longer for 16 times size' % (
+                shape, huge_time / small_time))